@@ -3,9 +3,9 @@
 # =============================================================================
 #
 # HOW TO RUN:
-#   1. pip install google-genai
+#   1. pip install google-genai "httpx[http2]" numpy
 #   2. Get a free API key from https://aistudio.google.com → "Get API key"
-#   3. Replace YOUR_API_KEY below (or set env var GEMINI_API_KEY)
+#   3. Set env var GEMINI_API_KEY (see Section 1)
 #   4. Run: python 15-gemini-api-basics.py
 #
 # WHAT THIS COVERS:
@@ -13,9 +13,24 @@
 #   - Reading the response object (text, tokens, finish reason)
 #   - Adding a system prompt
 #   - Multi-turn conversations
+#   - Running independent calls concurrently (client.aio + asyncio.gather)
+#   - Batching several small prompts into one request
+#   - Caching answers: exact repeats (memoization) and near-duplicates (embeddings)
+#   - Streaming responses chunk by chunk (generate_content_stream)
 # =============================================================================
 
+import asyncio
+import gzip
+import hashlib
+import io
+import json
 import os
+import re
+import sys
+from collections import deque
+
+import httpx
+import numpy as np
 from google import genai
 from google.genai import types
 
@@ -27,8 +42,129 @@ from google.genai import types
 
 # Load key from environment variable (safer than hardcoding)
 # Set it first: Windows → set GEMINI_API_KEY=your_key  |  Mac/Linux → export GEMINI_API_KEY=your_key
-API_KEY = os.environ.get("GEMINI_API_KEY", "YOUR_API_KEY")
-client = genai.Client(api_key=API_KEY)
+#
+# WHY check it here: a missing key (or the "YOUR_API_KEY" placeholder) stops
+#   the script with a clear message, instead of failing later as a confusing
+#   400/403 on the first real call. It's the same check _gemini.py runs for
+#   the later topics, which share one client instead of building their own.
+API_KEY = os.environ.get("GEMINI_API_KEY")
+if not API_KEY or API_KEY == "YOUR_API_KEY":
+    raise RuntimeError("Set the GEMINI_API_KEY environment variable (see HOW TO RUN).")
+
+
+# Connection pool settings shared by the sync and async transports.
+# WHY: Every HTTPS request needs a TCP connection + TLS handshake before any
+#      data moves (~100ms+, and real CPU for the crypto). A pooled transport
+#      keeps finished connections open ("keep-alive") and hands them to the
+#      next call, so only the first request pays the handshake.
+#      Older google-genai versions built a fresh httpx client per call when
+#      left to their defaults — passing our own transport guarantees reuse.
+POOL_LIMITS = httpx.Limits(
+    max_connections=100,            # upper bound on open sockets
+    max_keepalive_connections=50,   # idle sockets kept warm for reuse
+    keepalive_expiry=30,            # seconds an idle socket stays open
+)
+
+# Request compression.
+# WHY: Section 6 re-sends the conversation every turn as JSON text. English
+#      text gzips 3-5x, and on a slow home connection UPLOADING a multi-KB
+#      history can take longer than the server's work. So big request bodies
+#      are gzipped, with a Content-Encoding header telling the server to
+#      unzip it. Small bodies aren't worth the CPU — they go as-is.
+#      Google's API front end accepts gzip request bodies; not every server
+#      does (you'd get a 400), so check before copying this elsewhere.
+# HOW: An httpx transport is the last stop before bytes hit the socket.
+#      Subclass it, rewrite the request, hand it to the real transport.
+#      Only bodies already in memory (httpx.ByteStream) are compressed — a
+#      streamed upload (file, generator) passes through untouched instead
+#      of being read into memory first.
+GZIP_MIN_BYTES = 2048
+
+
+def _gzip_request(request: httpx.Request) -> httpx.Request:
+    """Return a gzip-encoded copy of the request (or the original if small/streamed)."""
+    if not isinstance(request.stream, httpx.ByteStream) or "Content-Encoding" in request.headers:
+        return request
+    body = request.read()   # already in memory — no I/O
+    if len(body) < GZIP_MIN_BYTES:
+        return request
+    headers = httpx.Headers(request.headers)
+    headers["Content-Encoding"] = "gzip"
+    # httpx sets the length of the new body itself
+    headers.pop("Content-Length", None)
+    headers.pop("Transfer-Encoding", None)
+    return httpx.Request(
+        request.method, request.url, headers=headers,
+        content=gzip.compress(body), extensions=request.extensions,  # keeps timeouts
+    )
+
+
+class GzipHTTPTransport(httpx.HTTPTransport):
+    def handle_request(self, request):
+        return super().handle_request(_gzip_request(request))
+
+
+class AsyncGzipHTTPTransport(httpx.AsyncHTTPTransport):
+    async def handle_async_request(self, request):
+        return await super().handle_async_request(_gzip_request(request))
+
+
+client = genai.Client(
+    api_key=API_KEY,
+    http_options=types.HttpOptions(
+        timeout=30_000,   # milliseconds — fail a stuck call instead of hanging
+        # client.models / client.chats (Sections 5-6)
+        client_args={
+            "transport": GzipHTTPTransport(retries=0, http2=True, limits=POOL_LIMITS),
+        },
+        # client.aio (Sections 2-4)
+        async_client_args={
+            "transport": AsyncGzipHTTPTransport(retries=0, http2=True, limits=POOL_LIMITS),
+        },
+    ),
+)
+# WHY timeout HERE, not in client_args: the SDK passes its own timeout to
+#      every request, and an httpx client timeout is only a default that a
+#      per-request value overrides. Left unset, that per-request value is
+#      None — "no timeout at all" — whatever the httpx client was built with.
+# WHY http2=True: HTTP/2 multiplexes many requests over ONE connection, so
+#      the concurrent calls in Sections 2-4 don't each need their own socket.
+#      Needs the h2 package — that's the [http2] extra in the pip command.
+# WHY retries=0: the SDK has its own retry logic; retrying at the transport
+#      layer too would multiply attempts.
+#
+# Construct ONE client at module level and reuse it everywhere. If you copy
+# this into a web server, do the same: build the client at startup, not
+# inside the request handler.
+
+# Warm-up: one tiny metadata request (list 1 model — no tokens, no cost).
+# WHY: The first request on a fresh client pays for DNS + TCP + TLS handshake
+#      + key validation — tens to hundreds of ms that have nothing to do with
+#      the model. If you time Section 2, it looks slower than it is. Paying
+#      that once, up front, leaves a warm, authenticated connection in the pool.
+#      This warms the SYNC pool (Sections 6-7); main() warms the async one.
+next(iter(client.models.list(config={"page_size": 1})), None)
+
+# Generation configs — built ONCE here, reused by every call that needs them.
+# WHY: GenerateContentConfig is a Pydantic model; building one validates every
+#      field. Inside a call site that validation reruns on every call — noise
+#      next to a network round-trip, but real overhead in a hot agent loop.
+#      The config doesn't change between calls, so build it once.
+SARCASTIC_CFG = types.GenerateContentConfig(
+    system_instruction="You are a sarcastic assistant who answers everything with exactly one dry sentence.",
+    max_output_tokens=100,  # cap the response length
+    temperature=0.7,        # 0 = deterministic, 2 = very creative (Gemini uses 0-2)
+)   # Section 4
+CONCISE_CFG = types.GenerateContentConfig(
+    system_instruction="You are a helpful assistant. Be concise."
+)   # Section 5
+SARCASTIC_SAMPLES_CFG = SARCASTIC_CFG.model_copy(
+    update={"candidate_count": 4}   # 4 different answers from ONE request
+)   # Section 4b
+LIST_OF_STRINGS_CFG = types.GenerateContentConfig(
+    response_mime_type="application/json",   # reply is JSON, not prose
+    response_schema=list[str],               # ...and specifically a list of strings
+)   # Section 3
 
 # FRAMEWORK EQUIVALENT:
 #   Pydantic AI: model is specified per-agent, no explicit client
@@ -37,48 +173,198 @@ client = genai.Client(api_key=API_KEY)
 
 
 # -----------------------------------------------------------------------------
-# SECTION 2: The simplest possible API call
-# WHY: This is the foundation. One input (contents), one output (response).
-#      Everything else builds on top of this.
+# HELPER: Reading the text straight from the response
+# WHY: response.text is a convenience property. Each time you read it, it
+#      walks candidates[0].content.parts, skips non-text and "thought" parts,
+#      and joins what's left. For the usual single-part answer that's wasted
+#      work — the text is already sitting in parts[0].text (the "full path"
+#      from the response object diagram in Section 3).
+#      Tiny per call; it adds up in an agent loop of thousands of calls.
+#      Anything else (multi-part tool-call replies, empty final stream chunks)
+#      falls back to .text, so the shortcut never changes the result.
 # -----------------------------------------------------------------------------
 
-print("=== SECTION 2: Basic Call ===")
+def fast_text(response):
+    """response.text without the aggregation, for single-part replies."""
+    candidates = response.candidates
+    if candidates and candidates[0].content and candidates[0].content.parts:
+        parts = candidates[0].content.parts
+        if len(parts) == 1 and parts[0].text is not None and not parts[0].thought:
+            return parts[0].text
+    return response.text
+
 
-response = client.models.generate_content(
-    model="gemini-2.0-flash",   # free tier model — fast and capable
-    contents="What is an API? Answer in one sentence."
-)
+# -----------------------------------------------------------------------------
+# HELPER: Memoize deterministic calls
+# WHY: At temperature=0 the model (nearly) always gives the same answer to the
+#      same request. Asking twice just pays twice — same latency, same tokens.
+#      So we keep answers in a dict keyed by a hash of the whole request and
+#      return the stored response on a repeat. Zero network, zero cost.
+#      Only temperature=0 calls are cached — anything above 0 is SUPPOSED to
+#      vary, and caching it would hide that.
+#      This is the same idea as Topic 16's caching, but on YOUR side: Gemini's
+#      cache makes a repeat cheaper; this one makes it free.
+# -----------------------------------------------------------------------------
 
-# The response object has many fields — .text is the shortcut to the text
-print(response.text)
+_RESPONSE_CACHE = {}
+_IN_FLIGHT = {}     # key → asyncio.Future for requests that haven't returned yet
+cache_stats = {"hits": 0, "misses": 0, "coalesced": 0}
+
+
+def _request_key(model, config, contents):
+    """SHA-256 of the request — same request, same key.
+
+    The WHOLE config is hashed (system_instruction, temperature, but also
+    max_output_tokens, candidate_count...) — change any setting and the
+    answer can change, so it must be a different key.
+    """
+    payload = json.dumps(
+        {"m": model, "cfg": config.model_dump(mode="json", exclude_none=True), "c": contents},
+        sort_keys=True,
+        # SDK objects (types.Content etc.) are Pydantic models → dump to dicts
+        default=lambda o: o.model_dump(mode="json") if hasattr(o, "model_dump") else str(o),
+    )
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+async def cached_generate(model, contents, config=None):
+    """generate_content, but temperature=0 requests are answered from memory."""
+    temperature = config.temperature if config else None
+    if temperature != 0:
+        return await client.aio.models.generate_content(
+            model=model, contents=contents, config=config
+        )
+
+    key = _request_key(model, config, contents)
+    if key in _RESPONSE_CACHE:
+        cache_stats["hits"] += 1
+        return _RESPONSE_CACHE[key]   # .text and .usage_metadata, as if fresh
+
+    # Same request already on its way? Wait for THAT answer instead of
+    # sending a duplicate. With asyncio.gather, two identical calls both start
+    # before either finishes — the dict above can't catch that; this can.
+    if key in _IN_FLIGHT:
+        cache_stats["coalesced"] += 1
+        return await _IN_FLIGHT[key]
+
+    cache_stats["misses"] += 1
+    future = asyncio.ensure_future(client.aio.models.generate_content(
+        model=model, contents=contents, config=config
+    ))
+    _IN_FLIGHT[key] = future
+    try:
+        response = await future
+    finally:
+        _IN_FLIGHT.pop(key, None)   # success or error, it's no longer in flight
+    _RESPONSE_CACHE[key] = response
+    return response
+
+# NOTE: The dict lives in memory, so it only helps repeats within ONE run.
+#       To survive restarts, write it to disk (json/sqlite) or use Redis.
 
 
 # -----------------------------------------------------------------------------
-# SECTION 3: Reading the full response object
-# WHY: In production you need more than just text — you need to know why the
-#      model stopped, and how many tokens you used (for cost and rate limits).
+# HELPER: Streaming
+# WHY: generate_content waits for the WHOLE answer before returning — the user
+#      stares at nothing for the full generation time. generate_content_stream
+#      hands you the answer in chunks as the model produces them, so the first
+#      words show up almost immediately (lower "time to first token").
+#      Total tokens and total time are the same; perceived latency is not.
 # -----------------------------------------------------------------------------
 
-print("\n=== SECTION 3: Response Object ===")
+async def collect_stream(stream, echo=False):
+    """Drain a response stream. Returns (full_text, last_chunk).
+
+    echo=True prints each chunk as it arrives. The last chunk is returned
+    because it's the one carrying finish_reason and usage_metadata.
+    """
+    pieces = []
+    last = None
+    async for chunk in stream:
+        text = fast_text(chunk) or ""   # the final chunk may carry metadata but no text
+        pieces.append(text)
+        if echo:
+            print(text, end="", flush=True)
+        last = chunk
+    if echo:
+        print()
+    return "".join(pieces), last
 
-response = client.models.generate_content(
-    model="gemini-2.0-flash",
-    contents="Name three programming languages."
-)
 
-# The text output
-print("Text:", response.text)
+# -----------------------------------------------------------------------------
+# SECTION 2: The simplest possible API call
+# WHY: This is the foundation. One input (contents), one output (response).
+#      Everything else builds on top of this.
+#
+# NOTE: Sections 2, 3 and 4 use client.aio — the async twin of client.models.
+#       Same arguments, same response object, but the call is awaited instead
+#       of blocking. That lets us run them all at once (see "RUNNING SECTIONS
+#       2-4" below).
+# -----------------------------------------------------------------------------
+
+async def section2():
+    """Basic call: one prompt in, answer streamed to the screen."""
+    print("=== SECTION 2: Basic Call ===")
+    stream = await client.aio.models.generate_content_stream(
+        model="gemini-2.0-flash",   # free tier model — fast and capable
+        contents="What is an API? Answer in one sentence."
+    )
+    # Each chunk is a partial response object — collect_stream reads its text
+    await collect_stream(stream, echo=True)
 
-# finish_reason tells you WHY the model stopped generating:
-#   "STOP"       = model decided it was done (normal)
-#   "MAX_TOKENS" = hit the output token limit
-#   "TOOL_CALLS" = model wants to call a tool (used in Topic 23)
-print("Finish reason:", response.candidates[0].finish_reason)
 
-# Token usage — important for cost tracking and context window management
-print("Input tokens: ", response.usage_metadata.prompt_token_count)
-print("Output tokens:", response.usage_metadata.candidates_token_count)
-print("Total tokens: ", response.usage_metadata.total_token_count)
+# -----------------------------------------------------------------------------
+# SECTION 3: Reading the full response object
+# WHY: In production you need more than just text — you need to know why the
+#      model stopped, and how many tokens you used (for cost and rate limits).
+# -----------------------------------------------------------------------------
+
+async def section3():
+    """A call whose response we inspect field by field."""
+    stream = await client.aio.models.generate_content_stream(
+        model="gemini-2.0-flash",
+        config=LIST_OF_STRINGS_CFG,   # structured output — see below
+        contents="Name three programming languages."
+    )
+    return await collect_stream(stream)   # buffered — see RUNNING SECTIONS 2-4
+
+
+def show_section3(result):
+    # Buffered output: print(..., file=buf) formats lines into memory, and
+    # one sys.stdout.write at the end sends the whole section at once —
+    # instead of one write (and maybe a flush) per print. Irrelevant next
+    # to an API call, but it's the residual cost once the calls are fast,
+    # and log collectors handle one block better than many fragments.
+    # (The STREAMING sections do the opposite on purpose: flush every chunk.)
+    buf = io.StringIO()
+    text, response = result   # response = the LAST chunk of the stream
+    print("\n=== SECTION 3: Response Object ===", file=buf)
+
+    # The text output (joined from all chunks). Because of response_schema it
+    # is a JSON array like ["Python", "Java", "C++"] — no prose, no markdown.
+    print("Text:", text, file=buf)
+
+    # STRUCTURED OUTPUT: With response_mime_type + response_schema the server
+    # constrains generation to valid JSON of that shape. One json.loads and
+    # you have a Python list — no regex, no splitting on commas, no retry
+    # loop for when the model wraps the answer in ```json fences.
+    languages = json.loads(text)
+    print("Parsed:", languages, f"({len(languages)} items)", file=buf)
+
+    # With streaming, finish_reason and usage_metadata arrive on the final
+    # chunk — earlier chunks don't know yet how the generation will end.
+
+    # finish_reason tells you WHY the model stopped generating:
+    #   "STOP"       = model decided it was done (normal)
+    #   "MAX_TOKENS" = hit the output token limit
+    #   "TOOL_CALLS" = model wants to call a tool (used in Topic 23)
+    print("Finish reason:", response.candidates[0].finish_reason, file=buf)
+
+    # Token usage — important for cost tracking and context window management
+    print("Input tokens: ", response.usage_metadata.prompt_token_count, file=buf)
+    print("Output tokens:", response.usage_metadata.candidates_token_count, file=buf)
+    print("Total tokens: ", response.usage_metadata.total_token_count, file=buf)
+    sys.stdout.write(buf.getvalue())   # the whole section in one write
 
 # FRAMEWORK EQUIVALENT for token usage:
 #   Pydantic AI: result.usage()  → Usage(input_tokens=X, output_tokens=Y)
@@ -86,6 +372,71 @@ print("Total tokens: ", response.usage_metadata.total_token_count)
 #   Google ADK:  available via tracing/telemetry
 
 
+# -----------------------------------------------------------------------------
+# SECTION 3b: Batching independent prompts into ONE request
+# WHY: Every request has fixed overhead — a round-trip, request parsing, and a
+#      slot in your requests-per-minute (RPM) quota. The free tier's RPM limit
+#      is hit long before its token limit. If you have N small, unrelated
+#      prompts, number them and send them together: N requests become 1.
+#      Fewer round-trips, one RPM slot, and any shared instructions are paid
+#      for once instead of N times.
+# TRADEOFF: One bad answer can't be retried on its own, and the model has to
+#      keep the answers separate — parse defensively.
+# -----------------------------------------------------------------------------
+
+BATCH_PROMPTS = [
+    "Name 3 programming languages.",
+    "Name 3 databases.",
+    "Name 3 operating systems.",
+]
+
+
+async def section3b():
+    """Send all BATCH_PROMPTS as one numbered request."""
+    numbered = "\n".join(f"{i}. {p}" for i, p in enumerate(BATCH_PROMPTS, 1))
+    return await client.aio.models.generate_content(
+        model="gemini-2.0-flash",
+        contents=(
+            "Answer each numbered question on its own line, starting the line "
+            "with the same number. Do not add any other text.\n" + numbered
+        ),
+    )
+
+
+def show_section3b(response):
+    buf = io.StringIO()
+    print("\n=== SECTION 3b: Batched Prompts (N prompts, 1 request) ===", file=buf)
+
+    # Map each answer back to its prompt by the leading number.
+    # Lines that don't start with "<number>." or "<number>)" are ignored.
+    answers = {}
+    for line in fast_text(response).splitlines():
+        match = re.match(r"\s*(\d+)[.)]\s*(.*)", line)
+        if match:
+            answers[int(match.group(1))] = match.group(2)
+
+    for i, prompt in enumerate(BATCH_PROMPTS, 1):
+        print(f"  Q{i}: {prompt}", file=buf)
+        print(f"  A{i}: {answers.get(i, '(missing from response)')}", file=buf)
+    print("Total tokens for all", len(BATCH_PROMPTS), "prompts:",
+          response.usage_metadata.total_token_count, file=buf)
+    sys.stdout.write(buf.getvalue())   # the whole section in one write
+
+# FOR OFFLINE WORK — BATCH MODE:
+#   If you don't need the answers right now (nightly evals, bulk labelling),
+#   the Batch API takes a whole list of separate requests and runs them
+#   asynchronously at ~50% of the normal price. Results can take minutes to
+#   hours, so it isn't run here:
+#
+#     job = client.batches.create(
+#         model="gemini-2.0-flash",
+#         src=[{"contents": [{"role": "user", "parts": [{"text": p}]}]}
+#              for p in BATCH_PROMPTS],        # or a JSONL file of requests
+#         config={"display_name": "topic-15-batch"},
+#     )
+#     # later: client.batches.get(name=job.name).state → JOB_STATE_SUCCEEDED
+
+
 # -----------------------------------------------------------------------------
 # SECTION 4: Adding a system prompt
 # WHY: The system prompt sets the role and rules for the model.
@@ -93,19 +444,49 @@ print("Total tokens: ", response.usage_metadata.total_token_count)
 #      This is how you configure behavior without repeating instructions every turn.
 # -----------------------------------------------------------------------------
 
-print("\n=== SECTION 4: System Prompt ===")
+async def section4():
+    """A call with a system prompt and generation settings."""
+    return await cached_generate(   # memoized when temperature=0
+        model="gemini-2.0-flash",
+        config=SARCASTIC_CFG,   # system prompt + settings, defined in Section 1
+        contents="What is machine learning?"
+    )
 
-response = client.models.generate_content(
-    model="gemini-2.0-flash",
-    config=types.GenerateContentConfig(
-        system_instruction="You are a sarcastic assistant who answers everything with exactly one dry sentence.",
-        max_output_tokens=100,  # cap the response length
-        temperature=0.7,        # 0 = deterministic, 2 = very creative (Gemini uses 0-2)
-    ),
-    contents="What is machine learning?"
-)
 
-print(response.text)
+def show_section4(response):
+    print("\n=== SECTION 4: System Prompt ===")
+    print(fast_text(response))
+
+# NOTE: Section 4 doesn't stream. It goes through cached_generate, and a
+#       memoized answer comes back instantly — there's nothing to stream.
+
+
+# -----------------------------------------------------------------------------
+# SECTION 4b: Several samples of the same prompt in ONE call
+# WHY: "Run it a few times and compare" usually means N identical requests —
+#      N round-trips, and the server reads (prefills) the same prompt N times.
+#      candidate_count=N asks for N independent answers in one request: one
+#      round-trip, one prefill, N samples. Handy for seeing how much
+#      temperature varies the output, or for picking the best of N.
+# -----------------------------------------------------------------------------
+
+async def section4b():
+    """Section 4's prompt, sampled several times in one request."""
+    return await cached_generate(
+        model="gemini-2.0-flash",
+        config=SARCASTIC_SAMPLES_CFG,   # SARCASTIC_CFG + candidate_count=4
+        contents="What is machine learning?"
+    )
+
+
+def show_section4b(response):
+    buf = io.StringIO()
+    print("\n=== SECTION 4b: Multiple Candidates, One Call ===", file=buf)
+    for i, candidate in enumerate(response.candidates, 1):
+        print(f"  Sample {i}: {candidate.content.parts[0].text.strip()}", file=buf)
+    # Output tokens are summed over ALL candidates — you pay for every sample
+    print("Output tokens (all samples):", response.usage_metadata.candidates_token_count, file=buf)
+    sys.stdout.write(buf.getvalue())   # the whole section in one write
 
 # FRAMEWORK EQUIVALENT for system prompt:
 #   Pydantic AI: Agent("gemini-2.0-flash", system_prompt="...")
@@ -113,41 +494,109 @@ print(response.text)
 #   Google ADK:  LlmAgent(instruction="...")
 
 
+# -----------------------------------------------------------------------------
+# RUNNING SECTIONS 2-4 CONCURRENTLY
+# WHY: The calls above don't depend on each other — none of them needs
+#      another's answer. Run one after another, the script waits ~1s for each
+#      (sum of latencies). asyncio.gather sends them all at once and waits
+#      for the slowest (max of latencies) — roughly 4x faster here.
+#      The waiting is network time, not CPU time, so one thread is enough.
+#
+#      gather returns results in the order you passed the coroutines, so we
+#      can still print the sections in order.
+#
+# STREAMING + CONCURRENCY: If every section printed chunks as they arrived,
+#      the answers would be shuffled together on screen. So only Section 2
+#      streams live; the others run in the background at the same time and
+#      are printed once Section 2 is done (they've usually finished by then).
+# -----------------------------------------------------------------------------
+
+async def run_sections_2_to_4():
+    # gather() starts these right away — they run while Section 2 streams
+    background = asyncio.gather(section3(), section3b(), section4(), section4b())
+    await section2()
+    s3, s3b, s4, s4b = await background
+    show_section3(s3)
+    show_section3b(s3b)
+    show_section4(s4)
+    show_section4b(s4b)
+
+# WHAT YOU CAN'T PARALLELIZE: Sections 5 and 6 below stay sequential.
+# Each turn needs the previous turn's answer in its history — a true data
+# dependency. Concurrency only helps when the calls are independent.
+
+# FRAMEWORK EQUIVALENT for concurrent calls:
+#   Pydantic AI: await asyncio.gather(agent.run(a), agent.run(b))
+#   LangGraph:   fan-out edges — parallel nodes in the same superstep
+#   Google ADK:  ParallelAgent runs sub-agents concurrently
+
+
 # -----------------------------------------------------------------------------
 # SECTION 5: Multi-turn conversation using the chat object
 # WHY: Real applications are multi-turn. The chat object manages the messages
 #      array for you — it appends each turn automatically so the model always
 #      has the full history. This is the in-context state from Topic 14.
+#
+# ASYNC CHAT: client.aio.chats is the async version of client.chats. The turns
+#      are still one after another (turn 2 needs turn 1's answer), so it isn't
+#      faster on its own. What it buys: while a turn is waiting on the network,
+#      the event loop is free for other work — streaming output, background
+#      calls, or reading the user's NEXT message in an interactive app:
+#
+#          next_msg = asyncio.create_task(asyncio.to_thread(input, "> "))
+#          reply = await chat.send_message(current_msg)   # read + RPC overlap
+#          current_msg = await next_msg
+#
+#      And it shares one event loop (and one client) with Sections 2-4.
 # -----------------------------------------------------------------------------
 
-print("\n=== SECTION 5: Multi-Turn Chat ===")
+async def section5():
+    print("\n=== SECTION 5: Multi-Turn Chat ===")
 
-# Create a chat session — this holds the message history internally
-chat = client.chats.create(
-    model="gemini-2.0-flash",
-    config=types.GenerateContentConfig(
-        system_instruction="You are a helpful assistant. Be concise."
+    # Create a chat session — this holds the message history internally
+    chat = client.aio.chats.create(
+        model="gemini-2.0-flash",
+        config=CONCISE_CFG,   # defined in Section 1
     )
-)
 
-# Turn 1
-response = chat.send_message("My name is Prajesh and I'm learning about AI agents.")
-print("Turn 1:", response.text)
+    async def stream_turn(label, message):
+        """Send one chat turn and print the reply as it streams in."""
+        print(f"{label}: ", end="")
+        await collect_stream(await chat.send_message_stream(message), echo=True)
+        # The chat object records the full streamed reply in its history
+
+    # Turn 1
+    await stream_turn("Turn 1", "My name is Prajesh and I'm learning about AI agents.")
+
+    # Turn 2 — the model remembers turn 1 because the chat object sent it again
+    await stream_turn("Turn 2", "What am I learning about?")
+
+    # Turn 3
+    await stream_turn("Turn 3", "And what's my name?")
+
+    # You can inspect the full message history the model is seeing.
+    # Extract every message in one list comprehension, then write it out in
+    # ONE call — instead of a format + print per message. Irrelevant at 6
+    # messages; noticeable when dumping a 1000-turn agent log for debugging.
+    print("\n--- Message history ---")
+    rows = [
+        {"role": m.role, "text": m.parts[0].text[:80] if m.parts else ""}
+        for m in chat.get_history()
+    ]
+    sys.stdout.write(json.dumps(rows, indent=2) + "\n")
+    # For the COMPLETE record (every part, not just the first 80 chars), let
+    # Pydantic serialize it: json.dumps([m.model_dump(mode="json") for m in ...])
+
 
-# Turn 2 — the model remembers turn 1 because the chat object sent it again
-response = chat.send_message("What am I learning about?")
-print("Turn 2:", response.text)
+async def main():
+    # Warm the async pool too — it's a separate pool from the sync one above.
+    # Awaited BEFORE the real work, so Section 2's latency is the model's only.
+    await client.aio.models.list(config={"page_size": 1})
+    await run_sections_2_to_4()
+    await section5()
 
-# Turn 3
-response = chat.send_message("And what's my name?")
-print("Turn 3:", response.text)
 
-# You can inspect the full message history the model is seeing
-print("\n--- Message history ---")
-for message in chat.get_history():
-    role = message.role
-    text = message.parts[0].text if message.parts else ""
-    print(f"  [{role}]: {text[:80]}...")
+asyncio.run(main())
 
 
 # -----------------------------------------------------------------------------
@@ -159,33 +608,144 @@ for message in chat.get_history():
 
 print("\n=== SECTION 6: Raw Message History (No Chat Helper) ===")
 
-# Build the conversation history manually as a list of Content objects
-history = []
-
-def send_message_raw(user_text: str) -> str:
-    """Send a message and update history manually."""
-    # Add user turn to history
-    history.append(types.Content(
-        role="user",
-        parts=[types.Part(text=user_text)]
-    ))
-
-    # Call the API with full history
-    response = client.models.generate_content(
+# Build the conversation history manually as a sequence of Content objects.
+# A deque with maxlen is a bounded window: once it holds HISTORY_WINDOW
+# messages, each append silently drops the oldest one from the front.
+# WHY bounded: a plain list grows forever, and every turn serializes and
+#      sends the WHOLE list — more bytes, more tokens, every single turn.
+#      The window caps what one call can cost.
+# WATCH OUT: Dropped turns are gone for good (the model forgets them) unless
+#      they were already frozen into the explicit cache below.
+HISTORY_WINDOW = 20       # messages, i.e. 10 user+model turn pairs
+history = deque(maxlen=HISTORY_WINDOW)
+
+# Explicit cache over the stable front of the history (see Topic 16).
+# WHY: Without it, every turn re-sends ALL earlier turns. Turn 10 pays for
+#      turns 1-9 again, turn 11 pays for 1-10 again... input tokens grow
+#      quadratically over a conversation. Once the history is big enough to
+#      cache, we freeze it into a cache and only send the turns after it.
+#      Cached tokens bill at ~1/4 price and the server skips re-processing them.
+CACHE_MIN_TOKENS = 4096   # explicit cache minimum for gemini-2.0-flash
+history_cache = None      # the cache object, once created
+history_config = None     # config pointing at the cache — built once, when it exists
+cached_turns = 0          # how many messages were moved into the cache
+
+
+# Message factories — one place that turns a string into a Content turn.
+# WHY: types.Content and types.Part are Pydantic models, and normal
+#      construction validates every field (Part checks which of its many
+#      variants — text, image, function call... — you meant). An agent loop
+#      (Topic 22) builds thousands of these, and it shows up in profiles.
+#      model_construct() is Pydantic's "trust me" constructor: it skips
+#      validation entirely. Safe ONLY because we know the input is a plain str
+#      and the role is one of two literals. For anything untrusted, use the
+#      normal constructor — or types.Part.from_text(text=...) — instead.
+def user_msg(text: str) -> types.Content:
+    return types.Content.model_construct(role="user", parts=[types.Part.model_construct(text=text)])
+
+
+def model_msg(text: str) -> types.Content:
+    return types.Content.model_construct(role="model", parts=[types.Part.model_construct(text=text)])
+
+
+# Context budget check (a preview of Topic 17).
+# WHY: If the history outgrows the context window, the API rejects the call —
+#      after a full round-trip. count_tokens is free and never generates, so
+#      asking "will this fit?" first lets us fix the history BEFORE sending.
+#      Budget = input limit minus room for the reply.
+MODEL_INPUT_LIMIT = 1_048_576   # gemini-2.0-flash context window
+MAX_OUTPUT_TOKENS = 8_192       # the most a reply can add
+CONTEXT_BUDGET = MODEL_INPUT_LIMIT - MAX_OUTPUT_TOKENS
+KEEP_RECENT = 4                 # messages kept verbatim when we summarize
+
+
+def fit_history(user_turn):
+    """Summarize the older part of the window if the next call wouldn't fit."""
+    # The cached prefix can't be counted via count_tokens together with the
+    # tail, but its size is on the cache object — add it on.
+    cached = history_cache.usage_metadata.total_token_count if history_cache else 0
+    total = cached + client.models.count_tokens(
+        model="gemini-2.0-flash", contents=[*history, user_turn]
+    ).total_tokens
+    if total <= CONTEXT_BUDGET or len(history) <= KEEP_RECENT:
+        return
+
+    old, recent = list(history)[:-KEEP_RECENT], list(history)[-KEEP_RECENT:]
+    print(f"  [{total} tokens > budget {CONTEXT_BUDGET}: summarizing {len(old)} messages]")
+    summary = fast_text(client.models.generate_content(
         model="gemini-2.0-flash",
-        contents=history,  # send ALL turns, not just the latest
-    )
-
-    # Add model response to history so next call includes it
-    history.append(types.Content(
-        role="model",
-        parts=[types.Part(text=response.text)]
+        contents=[*old, user_msg("Summarize our conversation so far in 2-3 sentences.")],
     ))
+    # The summary goes in as a user/model pair so the history still alternates
+    history.clear()
+    history.extend([
+        user_msg(f"[Summary of our earlier conversation: {summary}]"),
+        model_msg("Understood."),
+        *recent,
+    ])
 
-    return response.text
 
-print(send_message_raw("My favourite language is Python."))
-print(send_message_raw("What's my favourite language?"))  # model remembers
+def send_message_raw(user_text: str) -> str:
+    """Send a message and update history manually."""
+    global history_cache, history_config, cached_turns
+
+    user_turn = user_msg(user_text)
+    fit_history(user_turn)   # never send a call the API would reject
+
+    # Call the API with the history window + the new user turn.
+    # `history` only holds turns that are NOT in the cache — with a cache, the
+    # server prepends the cached part itself.
+    # Streamed: print chunks as they arrive, keep the text for the history,
+    # and keep the last chunk for its usage_metadata.
+    pieces = []
+    for response in client.models.generate_content_stream(
+        model="gemini-2.0-flash",
+        config=history_config,   # None until the cache exists
+        contents=[*history, user_turn],   # deques don't slice — unpack into a list
+    ):
+        text = fast_text(response) or ""
+        pieces.append(text)
+        print(text, end="", flush=True)
+    print()
+    reply = "".join(pieces)
+    # `response` is now the final chunk — it carries the token counts
+    if history_cache:
+        # Proof the cache was used — these tokens were not sent again
+        assert (response.usage_metadata.cached_content_token_count or 0) > 0
+
+    # Add the user turn AND the model response so the next call includes them.
+    # Appending them together means the window always evicts a whole pair —
+    # never a reply without its question.
+    history.append(user_turn)   # the same object we just sent — no re-wrapping
+    history.append(model_msg(reply))
+
+    # Big enough to cache? Freeze everything so far into an explicit cache.
+    # total_token_count = the history we just sent + the reply we just got,
+    # so we know the size without an extra count_tokens call.
+    if history_cache is None and response.usage_metadata.total_token_count >= CACHE_MIN_TOKENS:
+        history_cache = client.caches.create(
+            model="gemini-2.0-flash",
+            config=types.CreateCachedContentConfig(
+                contents=list(history),
+                ttl="600s",
+                display_name="topic-15-history",
+            ),
+        )
+        history_config = types.GenerateContentConfig(cached_content=history_cache.name)
+        cached_turns = len(history)
+        history.clear()   # those turns live in the cache now; the window starts fresh
+        print(f"  [Cached first {cached_turns} messages: {history_cache.name}]")
+
+    return reply
+
+send_message_raw("My favourite language is Python.")   # prints as it streams
+send_message_raw("What's my favourite language?")      # model remembers
+
+# These two short turns stay well under 4096 tokens, so no cache is created —
+# the uncached path runs. Paste a long document into the first message to
+# watch the cache kick in. Clean up if it did (storage is billed per hour):
+if history_cache:
+    client.caches.delete(name=history_cache.name)
 
 # WHY THIS MATTERS: This is the exact pattern used in the agent loop (Topic 22).
 # The loop appends tool results to this same history list and calls the API again.
@@ -196,11 +756,97 @@ print(send_message_raw("What's my favourite language?"))  # model remembers
 #   Google ADK:  session.history managed by the ADK runner
 
 
+
+# -----------------------------------------------------------------------------
+# SECTION 7: Semantic cache — reuse answers for near-duplicate questions
+# WHY: The memoization helper only catches EXACT repeats. Real users rephrase:
+#      "What is an API?" vs "Explain what an API is". An embedding turns text
+#      into a vector where similar meanings point in similar directions. If a
+#      new question's vector is close enough to one we've already answered,
+#      return that answer — one cheap embedding call instead of a generation.
+# WHEN NOT TO USE: Only for stateless questions. "What's my favourite
+#      language?" in Section 6 depends on the history — same words, different
+#      correct answer per conversation. Never semantic-cache those.
+# -----------------------------------------------------------------------------
+
+print("\n=== SECTION 7: Semantic Cache ===")
+
+EMBED_MODEL = "text-embedding-004"
+SIMILARITY_THRESHOLD = 0.92   # cosine similarity; higher = stricter match
+
+# One row per cached question (unit-length float32 vectors) + matching answers.
+# Keeping the vectors in one matrix means a lookup is ONE matrix-vector
+# multiply over every stored question, not a Python loop.
+_sem_vectors = None
+_sem_answers = []
+_sem_exact = {}     # normalized question → answer: exact repeats skip the embedding too
+
+
+def _embed(text: str) -> np.ndarray:
+    """Embed normalized text and scale it to unit length."""
+    result = client.models.embed_content(model=EMBED_MODEL, contents=text.strip().lower())
+    vec = np.asarray(result.embeddings[0].values, dtype=np.float32)
+    return vec / np.linalg.norm(vec)
+
+
+def semantic_generate(question: str) -> str:
+    """Answer a stateless question, reusing a cached answer if one is close enough."""
+    global _sem_vectors
+    normalized = question.strip().lower()
+    if normalized in _sem_exact:
+        print("  [Exact-match HIT — no embedding call]")
+        return _sem_exact[normalized]
+
+    q = _embed(question)
+
+    if _sem_vectors is not None:
+        # Vectors are unit length, so the dot product IS the cosine similarity
+        scores = _sem_vectors @ q
+        best = int(scores.argmax())
+        if scores[best] > SIMILARITY_THRESHOLD:
+            print(f"  [Semantic cache HIT — similarity {scores[best]:.3f}]")
+            _sem_exact[normalized] = _sem_answers[best]
+            return _sem_answers[best]
+        print(f"  [Semantic cache miss — best similarity {scores[best]:.3f}]")
+
+    response = client.models.generate_content(model="gemini-2.0-flash", contents=question)
+    _sem_vectors = q[None, :] if _sem_vectors is None else np.vstack([_sem_vectors, q])
+    answer = fast_text(response)
+    _sem_answers.append(answer)
+    _sem_exact[normalized] = answer
+    return answer
+
+
+print(semantic_generate("What is an API? Answer in one sentence."))
+print(semantic_generate("Explain what an API is, in one sentence."))   # paraphrase
+
+# SCALING UP: A NumPy matmul is fine for thousands of entries. Beyond that,
+# use a vector index — faiss.IndexFlatIP does the same dot-product search,
+# and the vector DBs from Topic 14 (Chroma, pgvector) do it persistently.
+# TUNING: Too low a threshold returns wrong answers for questions that are
+# merely related ("What is an API?" vs "What is a REST API?"). Start strict.
+
+# Local memoization results (HELPER at the top). Stays at 0 hits unless a
+# temperature=0 request is repeated within this run.
+print(f"\nResponse cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses, "
+      f"{cache_stats['coalesced']} coalesced in flight")
+
+
 # -----------------------------------------------------------------------------
 # THINGS TO TRY:
-# - Change the system_instruction in Section 4 and observe how the tone shifts
+# - Change the system_instruction in SARCASTIC_CFG (Section 4) and observe how the tone shifts
 # - In Section 5, ask something that requires memory of turn 1 ("what did I say?")
-# - In Section 6, print len(history) after each turn to see it growing
-# - Set temperature=0 and run Section 4 multiple times — does it give identical answers?
+# - In Section 6, print len(history) after each turn — it grows, then stops at
+#   HISTORY_WINDOW. Set HISTORY_WINDOW=2 and ask about the first turn
+# - In Section 6, make the first message a ~5000-word document and print
+#   cached_content_token_count on the next turn — the history is now cached
+# - Set temperature=0 in SARCASTIC_CFG and run Section 4 multiple times — does it give identical answers?
+#   (Section 4b does this in one call — are its 4 samples identical at temperature=0?)
+# - With temperature=0, add `show_section4(await section4())` at the end of
+#   main() — the repeat is served by cached_generate (watch the hit count)
+# - With temperature=0, add a second section4() to the gather in
+#   run_sections_2_to_4 — one request goes out, "coalesced" counts the other
 # - Set max_output_tokens=10 and see what finish_reason becomes
+# - In Section 6, set CONTEXT_BUDGET = 30 to force fit_history to summarize
+# - In Section 7, try "What is a REST API?" — is it a hit? Should it be?
 # -----------------------------------------------------------------------------
@@ -3,13 +3,13 @@
 # =============================================================================
 #
 # HOW TO RUN:
-#   1. pip install google-genai
+#   1. pip install google-genai tiktoken numpy
 #   2. Set your API key: set GEMINI_API_KEY=your_key  (Windows)
 #                        export GEMINI_API_KEY=your_key (Mac/Linux)
 #   3. Run: python 17-context-window-management.py
 #
 # WHAT THIS COVERS:
-#   - Token counting (exact via API + rough estimation)
+#   - Token counting (local tokenizer + exact via API)
 #   - Strategy 1: Truncation — drop oldest turns when over budget
 #   - Strategy 2: Sliding window — keep only last N turns
 #   - Strategy 3: Auto-summarization — compress old turns into a summary
@@ -36,17 +36,27 @@
 #   and manage the recent turns (dynamic, growing).
 # =============================================================================
 
-import os
-from google import genai
+import bisect
+import hashlib
+import itertools
+import json
+import pathlib
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import tiktoken
 from google.genai import types
 
 # --- Setup ---
-client = genai.Client(api_key=os.environ.get("GEMINI_API_KEY", "YOUR_API_KEY"))
+# Shared client — one connection pool for every topic script (see _gemini.py)
+from _gemini import client
 MODEL = "gemini-2.0-flash"
+_BANNER = "=" * 70   # section divider, built once
 
-print("=" * 70)
+print(_BANNER)
 print("TOPIC 17: Context Window Management")
-print("=" * 70)
+print(_BANNER)
 
 
 # =============================================================================
@@ -54,35 +64,88 @@ print("=" * 70)
 # =============================================================================
 # Before you can manage the window, you need to measure what's in it.
 # Two approaches:
-#   1. Exact count via API (costs a round-trip, but precise)
-#   2. Rough estimate (~4 chars per token, free, good for thresholds)
+#   1. Local tokenizer (no network, microseconds — use it by default)
+#   2. Exact count via API (costs a round-trip, but precise — use it sparingly)
+# The old ~4-chars-per-token rule of thumb is free too, but code, numbers,
+# URLs and non-English text tokenize very differently from prose, so its
+# error swings from a few % to 50%+ — too rough to budget with.
 # =============================================================================
 
-print("\n" + "=" * 70)
+print("\n" + _BANNER)
 print("PART 1: Token Counting")
-print("=" * 70)
+print(_BANNER)
+
+# --- Local tokenizer (offline) ---
+# A BPE tokenizer running in-process actually splits the text into tokens,
+# so it's the right tool for the "am I over budget?" checks we run on EVERY
+# turn below: an in-process encode takes microseconds, a count_tokens call
+# takes a ~100ms round-trip.
+# NOTE: tiktoken's cl100k_base is OpenAI's vocabulary, not Gemini's
+#       (Gemini uses its own SentencePiece vocabulary), so for Gemini the
+#       count drifts by roughly 5-15%. Budget with some headroom, and keep
+#       the exact API count for the pre-flight check right before a request
+#       that MUST fit.
+# The vocabulary file is downloaded once on first use and then read from
+# tiktoken's local cache — later runs work offline. Set TIKTOKEN_CACHE_DIR
+# to put that cache somewhere persistent (e.g. a CI cache or Docker volume).
+_ENCODING = tiktoken.get_encoding("cl100k_base")
+
+
+def count_local(text):
+    """Token count from a local BPE tokenizer — no API call."""
+    # disallowed_special=() → treat "<|endoftext|>" etc. as plain text
+    # instead of raising, since user messages can contain anything.
+    return len(_ENCODING.encode(text, disallowed_special=()))
+
 
-# --- Exact token counting via API ---
-# The count_tokens endpoint tells you exactly how many tokens a message uses.
-# This does NOT generate a response — it just counts.
 sample_text = "The quick brown fox jumps over the lazy dog. " * 50  # ~500 words
 
+local_count = count_local(sample_text)
+print(f"\nLocal token count (cl100k_base, approximate): {local_count}")
+print(f"Character count: {len(sample_text)}")
+print(f"Ratio: {len(sample_text) / local_count:.1f} chars per token")
+
+# --- Exact token counting via API ---
+# The count_tokens endpoint tells you exactly how many tokens a message uses
+# in Gemini's own vocabulary. This does NOT generate a response — it just
+# counts. Here we call it ONCE, to see how far off the local count is.
 response = client.models.count_tokens(
     model=MODEL,
     contents=sample_text
 )
 exact_count = response.total_tokens
 print(f"\nExact token count (via API): {exact_count}")
-print(f"Character count: {len(sample_text)}")
-print(f"Actual ratio: {len(sample_text) / exact_count:.1f} chars per token")
-
-# --- Rough estimation ---
-# Rule of thumb: ~4 characters per token for English text.
-# This is fast (no API call) and good enough for "should I trim?" checks.
-estimated_count = len(sample_text) // 4
-print(f"\nEstimated token count (~4 chars/token): {estimated_count}")
-print(f"Estimation error: {abs(exact_count - estimated_count)} tokens "
-      f"({abs(exact_count - estimated_count) / exact_count * 100:.1f}%)")
+print(f"Local tokenizer drift: {abs(exact_count - local_count)} tokens "
+      f"({abs(exact_count - local_count) / exact_count * 100:.1f}%)")
+
+# --- Memoized counting ---
+# In an agent loop the SAME text gets counted over and over — the system
+# prompt, a pinned document, old turns that haven't changed. Each exact count
+# is a network round-trip. Text that hasn't changed has the same count, so
+# remember it: key = a short fingerprint (hash) of the text, value = count.
+# We key on the 16-byte hash rather than the text itself so the memo table
+# doesn't keep copies of every long document it has seen.
+# Very short strings aren't worth a round-trip at all — count those locally.
+_token_counts = {}
+SHORT_TEXT_CHARS = 200
+
+
+def count_tokens(text):
+    """Exact token count, fetched once per distinct text (local if short)."""
+    if len(text) < SHORT_TEXT_CHARS:
+        return count_local(text)
+    fingerprint = hashlib.blake2b(text.encode(), digest_size=16).hexdigest()
+    if fingerprint not in _token_counts:
+        _token_counts[fingerprint] = client.models.count_tokens(
+            model=MODEL, contents=text
+        ).total_tokens
+    return _token_counts[fingerprint]
+
+
+count_tokens(sample_text)   # first time: one API call
+count_tokens(sample_text)   # same text: answered from _token_counts, no call
+print(f"\nMemoized count: {count_tokens(sample_text)} "
+      f"({len(_token_counts)} API call for 3 lookups of the same text)")
 
 # FRAMEWORK EQUIVALENT:
 # LangChain: tiktoken library for OpenAI models, or model.get_num_tokens()
@@ -100,11 +163,15 @@ print(f"Estimation error: {abs(exact_count - estimated_count)} tokens "
 # Cons: Old context is completely lost
 # =============================================================================
 
-print("\n" + "=" * 70)
+print("\n" + _BANNER)
 print("PART 2: Truncation Strategy")
-print("=" * 70)
+print(_BANNER)
 
 SYSTEM_PROMPT = "You are a helpful coding tutor. Keep answers brief (1-2 sentences)."
+# Config objects built once and reused by every call with the same settings.
+# WHY: GenerateContentConfig is a Pydantic model — constructing one validates
+#      every field. Same system prompt → same config, so build it once.
+TUTOR_CFG = types.GenerateContentConfig(system_instruction=SYSTEM_PROMPT)
 
 # Simulate a conversation history — 8 turn pairs
 conversation_history = [
@@ -158,9 +225,7 @@ new_question = "Can you remind me what we discussed about variables?"
 # because those early turns were dropped
 response = client.models.generate_content(
     model=MODEL,
-    config=types.GenerateContentConfig(
-        system_instruction=SYSTEM_PROMPT,
-    ),
+    config=TUTOR_CFG,
     contents=truncated + [{"role": "user", "parts": [{"text": new_question}]}]
 )
 print(f"\nQuestion: '{new_question}'")
@@ -185,9 +250,9 @@ print(f"  Tokens used: {response.usage_metadata.prompt_token_count} prompt, "
 # The distinction matters more in how you think about your system design.
 # =============================================================================
 
-print("\n" + "=" * 70)
+print("\n" + _BANNER)
 print("PART 3: Sliding Window Strategy")
-print("=" * 70)
+print(_BANNER)
 
 # Token-based sliding window (more precise than turn-based)
 def sliding_window_by_tokens(history, system_prompt, max_total_tokens=500):
@@ -199,31 +264,28 @@ def sliding_window_by_tokens(history, system_prompt, max_total_tokens=500):
     in length. One turn could be 10 tokens, another could be 5,000.
     Token-based gives you predictable cost and prevents window overflow.
 
-    We use the rough estimate here (len/4) to avoid extra API calls.
+    We count with the local tokenizer here — no API call per turn. The
+    count is approximate for Gemini, so leave headroom in max_total_tokens.
     For production systems, you'd count tokens when adding each turn.
-    """
-    # Start from the most recent turn pair and work backward
-    kept = []
-    running_tokens = len(system_prompt) // 4  # system prompt always included
-
-    # Walk backward through pairs (newest first)
-    for i in range(len(history) - 2, -1, -2):
-        user_msg = history[i]
-        model_msg = history[i + 1]
-
-        # Estimate tokens for this turn pair
-        pair_tokens = (
-            len(user_msg["parts"][0]["text"]) // 4 +
-            len(model_msg["parts"][0]["text"]) // 4
-        )
 
-        if running_tokens + pair_tokens > max_total_tokens:
-            break  # adding this pair would exceed budget
+    All messages are counted in ONE batch call before the loop: encode_batch
+    tokenizes the whole list in tiktoken's Rust core, across threads, instead
+    of paying Python call overhead once per message.
+    """
+    texts = [msg["parts"][0]["text"] for msg in history]
+    counts = [len(tokens) for tokens in _ENCODING.encode_batch(texts, disallowed_special=())]
+    system_tokens = count_local(system_prompt)  # system prompt always included
 
-        running_tokens += pair_tokens
-        kept = [user_msg, model_msg] + kept  # prepend to maintain order
+    # Instead of walking backward pair by pair, use running totals:
+    #   cum[i] = tokens in history[:i]   (cum[0] = 0, cum[-1] = everything)
+    # so history[start:] costs cum[-1] - cum[start]. cum only grows, so the
+    # first `start` that fits the budget is a binary search — O(log n),
+    # done in C by bisect — rather than a Python loop over every turn.
+    cum = list(itertools.accumulate(counts, initial=0))
+    start = bisect.bisect_left(cum, cum[-1] - (max_total_tokens - system_tokens))
+    start = min(start + start % 2, len(history))   # whole turn pairs only
 
-    return kept, running_tokens
+    return history[start:], system_tokens + cum[-1] - cum[start]
 
 
 kept_history, token_estimate = sliding_window_by_tokens(
@@ -232,7 +294,7 @@ kept_history, token_estimate = sliding_window_by_tokens(
 
 print(f"\nToken budget: 300 tokens")
 print(f"Turns that fit: {len(kept_history) // 2}")
-print(f"Estimated tokens used: {token_estimate}")
+print(f"Tokens used (local count, approximate): {token_estimate}")
 print(f"Oldest kept: '{kept_history[0]['parts'][0]['text'][:60]}...'")
 print(f"Newest kept: '{kept_history[-2]['parts'][0]['text'][:60]}...'")
 
@@ -250,9 +312,18 @@ print(f"Newest kept: '{kept_history[-2]['parts'][0]['text'][:60]}...'")
 # Tradeoff: costs an extra API call, but preserves context that truncation loses.
 # =============================================================================
 
-print("\n" + "=" * 70)
+print("\n" + _BANNER)
 print("PART 4: Auto-Summarization Strategy")
-print("=" * 70)
+print(_BANNER)
+
+
+SUMMARIZE_CFG = types.GenerateContentConfig(
+    system_instruction=(
+        "Summarize this conversation in 2-3 sentences. "
+        "Focus on: what topics were covered, key facts established, "
+        "and any decisions made. Be concise."
+    ),
+)
 
 
 def summarize_history(history_to_summarize):
@@ -267,21 +338,18 @@ def summarize_history(history_to_summarize):
     COST: This is an extra API call. It only pays off when the conversation
     is long enough that the token savings exceed the summarization cost.
     """
-    # Format the history as readable text for the summarizer
-    conversation_text = ""
-    for msg in history_to_summarize:
-        role = "User" if msg["role"] == "user" else "Assistant"
-        conversation_text += f"{role}: {msg['parts'][0]['text']}\n"
+    # Format the history as readable text for the summarizer.
+    # One join instead of `text += line` in a loop: += on a growing string
+    # can copy the whole thing every time (O(n²) over a long history);
+    # join sizes the result once and copies each piece once.
+    conversation_text = "\n".join(
+        f"{'User' if msg['role'] == 'user' else 'Assistant'}: {msg['parts'][0]['text']}"
+        for msg in history_to_summarize
+    )
 
     summary_response = client.models.generate_content(
         model=MODEL,
-        config=types.GenerateContentConfig(
-            system_instruction=(
-                "Summarize this conversation in 2-3 sentences. "
-                "Focus on: what topics were covered, key facts established, "
-                "and any decisions made. Be concise."
-            ),
-        ),
+        config=SUMMARIZE_CFG,
         contents=conversation_text
     )
     return summary_response.text.strip()
@@ -306,9 +374,7 @@ summarized_context = [
 # Ask the same question — the model now has summary context about variables
 response = client.models.generate_content(
     model=MODEL,
-    config=types.GenerateContentConfig(
-        system_instruction=SYSTEM_PROMPT,
-    ),
+    config=TUTOR_CFG,
     contents=summarized_context + [{"role": "user", "parts": [{"text": new_question}]}]
 )
 print(f"\nQuestion: '{new_question}'")
@@ -339,9 +405,28 @@ print(f"  Tokens used: {response.usage_metadata.prompt_token_count} prompt, "
 #   - Total token count stays bounded
 # =============================================================================
 
-print("\n" + "=" * 70)
+print("\n" + _BANNER)
 print("PART 5: Hybrid Strategy (Summary + Sliding Window)")
-print("=" * 70)
+print(_BANNER)
+
+
+# Lines that carry no information worth keeping: pure acknowledgements and
+# filler ("ok", "thanks!", "got it", "sounds good"). Matched on the WHOLE line.
+LOW_SIGNAL_LINE = re.compile(
+    r"^\s*(ok(ay)?|thanks?( you)?|thx|got it|sure|great|cool|nice|yes|no|yep|nope|"
+    r"sounds good|perfect|awesome|i see|makes sense|understood)[\s.!?]*$",
+    re.IGNORECASE,
+)
+# Lines that must survive verbatim no matter what: file paths (utils/io.py),
+# numbers, `code`, and ALL-CAPS names (error types, constants, env vars).
+HIGH_SIGNAL_LINE = re.compile(r"[\w./-]+\.\w+|\d|`|\b[A-Z][A-Z_]{2,}\b")
+
+
+# Near-duplicate turns ("What is X?" asked twice in different words) only
+# need summarizing once. Embeddings tell us which turns say the same thing.
+EMBED_MODEL = "text-embedding-004"
+DEDUP_THRESHOLD = 0.92      # cosine similarity; higher = only drop closer matches
+MAX_SEGMENTS = 8            # segment summaries kept before folding them into one
 
 
 class ConversationManager:
@@ -352,71 +437,347 @@ class ConversationManager:
     beyond a threshold, old turns get summarized and replaced.
 
     HOW IT WORKS:
-    1. Every turn gets added to the full history
-    2. Before each API call, check if history exceeds the threshold
-    3. If yes: summarize the oldest turns, keep recent ones verbatim
+    1. Every turn gets recorded (in memory with debug=True, else to log_path)
+    2. After each turn, check if history exceeds the threshold
+    3. If yes: summarize the oldest turns IN THE BACKGROUND, keep recent
+       ones verbatim — the summary is swapped in once it's ready
     4. The context sent to the API is always: system + summary + recent + new
 
+    THE SUMMARY HAS TWO TIERS:
+    Each compression adds one short SEGMENT summary of just the turns it
+    compressed. Once there are more than MAX_SEGMENTS, they are folded into
+    a single TOP summary (one LLM call) and the segment list starts over.
+    WHY: One flat summary re-fed into every compression gets rewritten again
+    and again, losing early detail each time; appending forever grows
+    without bound. Two tiers keep the summarizer's input bounded (at most
+    MAX_SEGMENTS short segments) and leave recent history at full detail.
+
     FRAMEWORK EQUIVALENT:
     LangChain: ConversationSummaryBufferMemory(max_token_limit=500)
     This is EXACTLY what it does internally — same algorithm, packaged up.
     """
 
-    def __init__(self, system_prompt, max_recent_turns=3, summarize_threshold=6):
+    # Same instruction for every manager, so one shared config (see TUTOR_CFG)
+    COMPRESS_CFG = types.GenerateContentConfig(
+        system_instruction=(
+            "Summarize the new conversation turns in 1-2 sentences. "
+            "Capture the key topics, facts, and decisions. Be concise."
+        ),
+    )
+
+    FOLD_CFG = types.GenerateContentConfig(
+        system_instruction=(
+            "Merge these conversation summaries, oldest first, into one summary "
+            "of 2-3 sentences. Keep every key fact and decision. Be concise."
+        ),
+    )
+
+    # __slots__: a fixed set of attributes instead of a per-instance __dict__.
+    # Smaller objects and faster attribute access — and a typo like
+    # self.sumary = ... raises AttributeError instead of silently adding one.
+    __slots__ = (
+        "system_prompt", "_chat_cfg", "max_recent_turns", "summarize_threshold",
+        "full_history", "log_path", "_top_summary", "_segment_summaries", "turn_count",
+        "_roles", "_texts", "_messages", "_tokens", "_cum",
+        "summary_store", "compact_budget", "stats",
+        "context_limit_tokens", "_executor", "_pending",
+        "_prefix", "_fixed_tokens", "_embeddings",
+    )
+
+    def __init__(self, system_prompt, max_recent_turns=3, summarize_threshold=6,
+                 summary_store=None, compact_budget=50, context_limit_tokens=8000,
+                 debug=False, log_path=None):
         self.system_prompt = system_prompt
+        self._chat_cfg = types.GenerateContentConfig(system_instruction=system_prompt)
         self.max_recent_turns = max_recent_turns
         self.summarize_threshold = summarize_threshold  # trigger after this many turns
-        self.full_history = []      # complete record (for debugging)
-        self.summary = None         # compressed old context
-        self.recent_turns = []      # last N turns, kept verbatim
+        # The complete record of every turn, for debugging.
+        # WHY not always a list: it's a second in-memory copy of every
+        # message that the manager itself never reads — in a long session
+        # that doubles memory for nothing. So keep it in memory only when
+        # debugging; otherwise append it to a JSONL file (one JSON object
+        # per line) if log_path is given — appends are cheap, reads are rare.
+        self.full_history = [] if debug else None
+        self.log_path = pathlib.Path(log_path) if log_path else None
+        self._top_summary = None    # compressed OLD context (folded segments)
+        self._segment_summaries = []  # one short summary per compression since the last fold
+        # Last N turns, kept verbatim — as two parallel lists ("struct of
+        # arrays") instead of one list of {"role", "parts": [{"text"}]} dicts.
+        # WHY: every scan over the window (counting tokens, slicing off the
+        #      oldest turns) only needs the text. Here that's a flat list of
+        #      strings — no dict lookups or nested lists to walk per message.
+        #      The dict shape the API wants is built once, in build_context.
+        self._roles = []            # "user" / "model", one per message
+        self._texts = []            # message text, same index as _roles
+        self._messages = []         # API-shaped dict, built once per message
+        # Token count per message, counted ONCE when the message is added.
+        # Messages never change after that, so no scan ever re-tokenizes.
+        self._tokens = []           # same index as _roles / _texts
+        # Running totals of _tokens: _cum[i] = tokens in the first i messages.
+        # add_turn extends it, so budget checks are a bisect, never a sum.
+        self._cum = [0]
         self.turn_count = 0
-
-    def add_turn(self, user_message, model_response):
-        """Record a complete turn pair."""
-        self.full_history.append({"role": "user", "parts": [{"text": user_message}]})
-        self.full_history.append({"role": "model", "parts": [{"text": model_response}]})
-        self.recent_turns.append({"role": "user", "parts": [{"text": user_message}]})
-        self.recent_turns.append({"role": "model", "parts": [{"text": model_response}]})
+        # Summaries already computed, keyed by a hash of what was summarized.
+        # Any dict-like works: pass shelve.open("summaries.db") and a
+        # restarted process replaying the same conversation skips the calls.
+        self.summary_store = {} if summary_store is None else summary_store
+        # If the old turns fit in compact_budget tokens after _compact, they're
+        # kept as-is and no summarization call is made at all.
+        self.compact_budget = compact_budget
+        self.stats = {"compressions": 0, "llm_summaries": 0, "deduped_turns": 0, "folds": 0,
+                      "tokens_before_compact": 0, "tokens_after_compact": 0}
+        # Unit-length embedding per summarized turn pair, keyed by a hash of
+        # its text: each pair is embedded once, and later compressions can
+        # also drop new turns that repeat ones summarized earlier.
+        self._embeddings = {}
+        # Compression runs on a background thread so the user never waits
+        # for the summarization call (see add_turn / _apply_compression).
+        self.context_limit_tokens = context_limit_tokens
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._pending = None        # (Future[str], n_messages) while running
+        self._prefix = []           # summary turn pair — see _build_prefix
+        # Tokens that every request carries besides the window: the system
+        # prompt, plus the summary once there is one.
+        self._fixed_tokens = count_local(system_prompt)
+
+    def add_turn(self, user_message, model_response, model_tokens=None):
+        """Record a complete turn pair (model_tokens: count, if already known)."""
+        if self.full_history is not None:
+            # (role, text) tuples — one small object per message instead of
+            # two dicts and a list. The API shape is only built when sending.
+            self.full_history += (("user", user_message), ("model", model_response))
+        if self.log_path is not None:
+            with self.log_path.open("a", encoding="utf-8") as log:
+                log.write(json.dumps({"role": "user", "text": user_message}) + "\n"
+                          + json.dumps({"role": "model", "text": model_response}) + "\n")
+        self._roles += ("user", "model")
+        self._texts += (user_message, model_response)
+        # Build the API dicts ONCE, here. A message never changes after it's
+        # recorded, so build_context can reuse them on every later turn.
+        self._messages += (
+            {"role": "user", "parts": [{"text": user_message}]},
+            {"role": "model", "parts": [{"text": model_response}]},
+        )
+        user_tokens = count_local(user_message)
+        if model_tokens is None:
+            model_tokens = count_local(model_response)
+        self._tokens += (user_tokens, model_tokens)
+        self._cum += (self._cum[-1] + user_tokens, self._cum[-1] + user_tokens + model_tokens)
         self.turn_count += 1
 
-        # Check if we need to summarize
-        if len(self.recent_turns) // 2 > self.summarize_threshold:
-            self._compress()
-
-    def _compress(self):
-        """Summarize old turns, keep only recent ones."""
-        # Split: summarize all but the last max_recent_turns
-        keep_count = self.max_recent_turns * 2
-        to_summarize = self.recent_turns[:-keep_count]
-        to_keep = self.recent_turns[-keep_count:]
+        self._maybe_compress()
 
-        print(f"\n  [Auto-compressing: summarizing {len(to_summarize) // 2} turns, "
-              f"keeping {len(to_keep) // 2} recent turns]")
-
-        # If we already have a summary, include it in what we're summarizing
-        if self.summary:
-            summary_prefix = f"Previous summary: {self.summary}\n\n"
-        else:
-            summary_prefix = ""
+    def _maybe_compress(self, incoming_turns=0):
+        """
+        Start a background compression if the window is (or is about to be)
+        over the threshold.
 
-        conversation_text = summary_prefix
-        for msg in to_summarize:
-            role = "User" if msg["role"] == "user" else "Assistant"
-            conversation_text += f"{role}: {msg['parts'][0]['text']}\n"
+        incoming_turns: turns that will be added before the next check — chat()
+        passes 1 so compression can start while the answer is still streaming.
+        """
+        # Check if we need to summarize — and start it in the background.
+        # WHY: Summarizing is a second LLM call. Run it inline and the turn
+        #      that crosses the threshold takes twice as long. On a worker
+        #      thread it overlaps with the user reading the answer and
+        #      typing the next message; until it's done, build_context just
+        #      sends the old summary + the (slightly longer) recent turns.
+        if self.window_turns + incoming_turns > self.summarize_threshold and self._pending is None:
+            # Split: summarize all but the last max_recent_turns
+            keep_count = self.max_recent_turns * 2
+            n_old = len(self._texts) + 2 * incoming_turns - keep_count
+            # Only turns that exist NOW can be summarized — with
+            # max_recent_turns=0 the count above includes the incoming turn,
+            # which _apply_compression would later drop unsummarized.
+            n_old = min(n_old, len(self._texts))
+            if n_old <= 0:
+                return      # threshold below max_recent_turns: nothing old to summarize
+            print(f"\n  [Auto-compressing in the background: summarizing "
+                  f"{n_old // 2} turns, keeping {keep_count // 2} recent turns]")
+            future = self._executor.submit(
+                self._compress_and_fold, self._roles[:n_old], self._texts[:n_old],
+                self._top_summary, list(self._segment_summaries),
+            )
+            self._pending = (future, n_old)
+
+    @property
+    def summary(self):
+        """All compressed context as one string: top summary + segments."""
+        parts = [self._top_summary] if self._top_summary else []
+        return " ".join(parts + self._segment_summaries) or None
+
+    @property
+    def window_turns(self):
+        """How many turn pairs are currently kept verbatim."""
+        return len(self._texts) // 2
+
+    def _apply_compression(self, wait=False):
+        """Swap in a finished background summary (or wait for it if asked)."""
+        if self._pending is None:
+            return
+        future, n_messages = self._pending
+        if not (wait or future.done()):
+            return      # still running — use the old summary for this turn
+        self._top_summary, self._segment_summaries = future.result()
+        self._pending = None
+        # Only the messages that were summarized are dropped — turns added
+        # while the summary was being written stay in the window.
+        del self._roles[:n_messages]
+        del self._texts[:n_messages]
+        del self._messages[:n_messages]
+        del self._tokens[:n_messages]
+        self._cum = list(itertools.accumulate(self._tokens, initial=0))  # rare: once per compression
+        self._prefix = self._build_prefix()
+        self._fixed_tokens = count_local(self.system_prompt) + count_local(self.summary)
+        print(f"  [New summary: \"{self.summary}\"]")
 
-        summary_response = client.models.generate_content(
+    def _build_prefix(self):
+        """
+        The summary turn pair that starts every context — built once per summary.
+
+        WHY build it here and not in build_context: The summary only changes
+        when a compression lands, but build_context runs on every turn. Build
+        the pair once and every turn reuses the SAME objects — and sends the
+        same bytes. An identical prefix is what provider-side prefix caching
+        matches on (Gemini's implicit caching on 2.5 models, Anthropic's
+        prompt caching). Once system prompt + summary pass the 4096-token
+        minimum you could also put them in an explicit cache (Topic 16) and
+        pass cached_content instead of sending them at all; this demo's
+        summary is far too short for that.
+        """
+        if not self.summary:
+            return []
+        return [
+            {"role": "user",
+             "parts": [{"text": f"[Conversation summary so far: {self.summary}]"}]},
+            {"role": "model",
+             "parts": [{"text": "I recall our previous discussion. How can I help?"}]},
+        ]
+
+    def _compress_and_fold(self, roles, texts, top, segments):
+        """Background job: add one segment summary, fold if there are too many."""
+        prior = " ".join(([top] if top else []) + segments) or None
+        segment = self._compress(roles, texts, prior)
+        if segment:     # empty if every old turn was a duplicate
+            segments = segments + [segment]
+        if len(segments) > MAX_SEGMENTS:
+            top, segments = self._fold(top, segments), []
+        return top, segments
+
+    def _fold(self, top, segments):
+        """Merge the top summary and all segment summaries into one."""
+        self.stats["folds"] += 1
+        response = client.models.generate_content(
             model=MODEL,
-            config=types.GenerateContentConfig(
-                system_instruction=(
-                    "Summarize this conversation in 2-3 sentences. "
-                    "Capture the key topics, facts, and decisions. Be concise."
-                ),
-            ),
-            contents=conversation_text
+            config=self.FOLD_CFG,
+            contents="\n".join(([f"Earlier: {top}"] if top else []) + segments),
         )
-        self.summary = summary_response.text.strip()
-        self.recent_turns = to_keep
-        print(f"  [New summary: \"{self.summary}\"]")
+        return response.text.strip()
+
+    def _compress(self, roles, texts, prior_summary):
+        """Summarize old turns into new summary text (runs on the worker thread)."""
+
+        # Incremental: summarize ONLY the turns that are new since the last
+        # compression, then append that to the existing summary.
+        # WHY: Re-summarizing "previous summary + new turns" from scratch
+        #      rewrites the old summary every time — it costs output tokens
+        #      for facts we already had, and each rewrite loses a bit more
+        #      detail from the early turns. The old summary stays fixed and
+        #      is sent only as a short context header, so the model knows
+        #      what's already covered.
+        roles, texts = self._dedup(roles, texts)
+        conversation_text = self._compact(roles, texts)
+        self.stats["compressions"] += 1
+
+        # Small enough after compaction? Keep those lines verbatim — exact
+        # wording, zero API calls. Only a residual that's still too big
+        # goes to the LLM.
+        if count_local(conversation_text) <= self.compact_budget:
+            return conversation_text.replace("\n", " ").strip()
+
+        key = hashlib.blake2b(
+            f"{prior_summary}\0{conversation_text}".encode(), digest_size=16
+        ).hexdigest()
+        new_summary = self.summary_store.get(key)
+        if new_summary is None:
+            context_header = (
+                f"Already summarized (do not repeat): {prior_summary}\n\n"
+                if prior_summary else ""
+            )
+            summary_response = client.models.generate_content(
+                model=MODEL,
+                config=self.COMPRESS_CFG,
+                contents=context_header + "New turns:\n" + conversation_text
+            )
+            new_summary = summary_response.text.strip()
+            self.summary_store[key] = new_summary
+            self.stats["llm_summaries"] += 1
+        return new_summary
+
+    def _dedup(self, roles, texts):
+        """
+        Drop turn pairs that say nearly the same thing as one already kept.
+
+        One batched embed_content call embeds every pair not seen before;
+        one matrix multiply then gives every cosine similarity at once.
+        Walking newest → oldest means a restated question keeps its LATEST
+        wording. Costs one embedding call (far cheaper than a generation)
+        and shrinks what the summarizer has to read.
+        """
+        pairs = [f"{texts[i]}\n{texts[i + 1]}" for i in range(0, len(texts), 2)]
+        if not pairs:
+            return roles, texts     # nothing to embed — np.stack([]) would raise
+        keys = [hashlib.blake2b(p.encode(), digest_size=16).digest() for p in pairs]
+        earlier = list(self._embeddings.values())   # pairs from past compressions
+
+        missing = {k: p for k, p in zip(keys, pairs) if k not in self._embeddings}
+        if missing:
+            result = client.models.embed_content(model=EMBED_MODEL, contents=list(missing.values()))
+            for key, emb in zip(missing, result.embeddings):
+                vec = np.asarray(emb.values, dtype=np.float32)
+                self._embeddings[key] = vec / np.linalg.norm(vec)
+
+        vectors = np.stack([self._embeddings[k] for k in keys])     # (n_pairs, dim)
+        # Unit vectors → dot product = cosine similarity. Columns: earlier
+        # pairs first, then this batch (column len(earlier) + j = pair j).
+        sims = vectors @ np.vstack(earlier + [vectors]).T
+        offset = len(earlier)
+        kept = []
+        for i in reversed(range(len(pairs))):
+            against = list(range(offset)) + [offset + j for j in kept]
+            if not against or sims[i, against].max() < DEDUP_THRESHOLD:
+                kept.append(i)
+        kept.reverse()
+
+        self.stats["deduped_turns"] += len(pairs) - len(kept)
+        kept_roles, kept_texts = [], []
+        for i in kept:
+            kept_roles += roles[2 * i:2 * i + 2]
+            kept_texts += texts[2 * i:2 * i + 2]
+        return kept_roles, kept_texts
+
+    def _compact(self, roles, texts):
+        """
+        Drop low-signal lines verbatim — a free, deterministic pre-pass.
+
+        A lot of what falls out of the window is chatter ("ok", "thanks!").
+        Deleting those lines costs no API call and can't hallucinate, and
+        everything kept stays word-for-word. Lines with paths, numbers, code
+        or ALL-CAPS names are always kept, even if they look like filler.
+        """
+        all_lines, kept_lines = [], []
+        for role, text in zip(roles, texts):
+            role = "User" if role == "user" else "Assistant"
+            for line in text.splitlines():
+                all_lines.append(f"{role}: {line}")
+                if not line.strip():
+                    continue
+                if LOW_SIGNAL_LINE.match(line) and not HIGH_SIGNAL_LINE.search(line):
+                    continue
+                kept_lines.append(all_lines[-1])
+        compacted = "\n".join(kept_lines) + "\n"
+        self.stats["tokens_before_compact"] += count_local("\n".join(all_lines) + "\n")
+        self.stats["tokens_after_compact"] += count_local(compacted)
+        return compacted
 
     def build_context(self, new_message):
         """
@@ -427,43 +788,84 @@ class ConversationManager:
           [recent turns verbatim]
           [new user message]
         """
-        context = []
-
-        # Add summary as context (if we have one)
-        if self.summary:
-            context.append({
-                "role": "user",
-                "parts": [{"text": f"[Conversation summary so far: {self.summary}]"}]
-            })
-            context.append({
-                "role": "model",
-                "parts": [{"text": "I recall our previous discussion. How can I help?"}]
-            })
-
-        # Add recent turns
-        context.extend(self.recent_turns)
-
-        # Add new message
-        context.append({"role": "user", "parts": [{"text": new_message}]})
-
-        return context
+        # A background summary that's finished gets used now. One that's
+        # still running is only waited for if the window is getting close
+        # to the hard limit — otherwise this turn goes out without it.
+        if self._pending is not None:
+            recent_tokens = self._cum[-1]   # precounted — no tokenizing or summing here
+            self._apply_compression(wait=recent_tokens > 0.8 * self.context_limit_tokens)
+
+        # Hard limit: if the window STILL doesn't fit (one huge pasted message
+        # can do that), leave the oldest turns out of THIS request. They stay
+        # in the window, so the next compression still summarizes them.
+        budget = self.context_limit_tokens - self._fixed_tokens - count_local(new_message)
+        start = self._window_start(budget)
+
+        # Summary pair (prebuilt) + recent turns (prebuilt) + new message.
+        # WHY prebuilt: Rebuilding every window message as fresh dicts each
+        # turn is the same work, repeated, for text that never changes. Now
+        # the only dict built per turn is the new message — the rest is two
+        # list slices. (The SDK reads these dicts; it doesn't modify them.)
+        return self._prefix + self._messages[start:] + [
+            {"role": "user", "parts": [{"text": new_message}]}
+        ]
+
+    def _window_start(self, budget):
+        """Index of the oldest message that fits in `budget` tokens, newest kept first."""
+        # Messages [start:] cost _cum[-1] - _cum[start]; _cum only grows, so
+        # the first start that fits is a binary search (same as Part 3).
+        start = bisect.bisect_left(self._cum, self._cum[-1] - budget)
+        return min(start + start % 2, len(self._tokens))   # whole turn pairs only
+
+    def chat(self, user_message, echo=False):
+        """
+        Send a message and get a response, with automatic context management.
 
-    def chat(self, user_message):
-        """Send a message and get a response, with automatic context management."""
+        The answer is streamed; with echo=True it's printed as it arrives.
+        """
         context = self.build_context(user_message)
 
-        response = client.models.generate_content(
+        # Will THIS turn push the window over the threshold? We know before
+        # the answer exists: the turns to summarize are all old ones, and
+        # this turn is among the ones kept. So start compressing now — it
+        # runs during generation instead of after it.
+        self._maybe_compress(incoming_turns=1)
+
+        if echo:
+            print("  Model: ", end="", flush=True)
+        chunks, model_tokens, last = [], 0, None
+        for chunk in client.models.generate_content_stream(
             model=MODEL,
-            config=types.GenerateContentConfig(
-                system_instruction=self.system_prompt,
-            ),
+            config=self._chat_cfg,     # built once in __init__
             contents=context
-        )
-
-        model_text = response.text.strip()
-        self.add_turn(user_message, model_text)
-
-        return model_text, response.usage_metadata
+        ):
+            text = chunk.text or ""
+            chunks.append(text)
+            # Count while the stream is still arriving, so there's nothing
+            # left to measure when it ends. (Per-chunk counts can differ
+            # from counting the whole text by a token at chunk boundaries —
+            # fine for a budget estimate.)
+            model_tokens += count_local(text)
+            if echo:
+                print(text, end="", flush=True)
+            last = chunk
+        if echo:
+            print()
+
+        model_text = "".join(chunks).strip()
+        self.add_turn(user_message, model_text, model_tokens)
+
+        # usage_metadata arrives on the last chunk (no chunks → no usage)
+        return model_text, None if last is None else last.usage_metadata
+
+    def close(self):
+        """Finish any background compression, then stop the worker thread."""
+        # WHY: The last compression may still be running when the
+        #      conversation ends — writing self.stats and _embeddings while
+        #      the caller reads them. Wait for it, swap it in, then shut the
+        #      executor down so its thread doesn't outlive the manager.
+        self._apply_compression(wait=True)
+        self._executor.shutdown()
 
 
 # --- Run a multi-turn conversation that triggers auto-summarization ---
@@ -486,22 +888,34 @@ questions = [
 
 for q in questions:
     print(f"\n  User: {q}")
-    answer, usage = manager.chat(q)
-    print(f"  Model: {answer}")
-    print(f"  [Tokens: {usage.prompt_token_count} prompt, "
-          f"{usage.candidates_token_count} response | "
+    answer, usage = manager.chat(q, echo=True)   # prints "Model: ..." as it streams
+    tokens = (f"{usage.prompt_token_count} prompt, {usage.candidates_token_count} response"
+              if usage else "not reported")
+    print(f"  [Tokens: {tokens} | "
           f"History: {manager.turn_count} total turns, "
-          f"{len(manager.recent_turns) // 2} in window"
+          f"{manager.window_turns} in window"
           f"{', has summary' if manager.summary else ''}]")
 
+# Conversation over: apply (and wait for) the last background compression,
+# so the stats below are final rather than racing the worker thread.
+manager.close()
+
+# How much did the free compaction pass save before any LLM call?
+st = manager.stats
+if st["compressions"]:
+    print(f"\n  [Compaction: {st['tokens_before_compact']} → {st['tokens_after_compact']} tokens "
+          f"over {st['compressions']} compression(s), "
+          f"{st['llm_summaries']} needed an LLM summary, "
+          f"{st['deduped_turns']} near-duplicate turn(s) dropped]")
+
 
 # =============================================================================
 # PART 6: COMPARING THE STRATEGIES — Side by Side
 # =============================================================================
 
-print("\n" + "=" * 70)
+print("\n" + _BANNER)
 print("PART 6: Strategy Comparison")
-print("=" * 70)
+print(_BANNER)
 
 print("""
 Strategy          | Complexity  | Context Loss | Extra API Cost
@@ -529,14 +943,15 @@ REAL-WORLD EXAMPLES:
 # =============================================================================
 # SUMMARY
 # =============================================================================
-print("=" * 70)
+print(_BANNER)
 print("KEY TAKEAWAYS")
-print("=" * 70)
+print(_BANNER)
 print("""
 1. PROBLEM: Context windows have hard limits. Even below limits, more
    tokens = more cost + slower responses.
 
-2. TOKEN COUNTING: Use count_tokens() for precision, len//4 for estimates.
+2. TOKEN COUNTING: Count locally (tiktoken) for per-turn budget checks;
+   call count_tokens() only when you need the exact number.
 
 3. TRUNCATION: Drop oldest turns. Simple but loses all old context.
 
@@ -3,10 +3,11 @@
 # =============================================================================
 #
 # HOW TO RUN:
-#   1. pip install google-genai
+#   1. pip install google-genai orjson numpy tiktoken
 #   2. Set your API key: set GEMINI_API_KEY=your_key  (Windows)
 #                        export GEMINI_API_KEY=your_key (Mac/Linux)
 #   3. Run: python 18-prompt-chaining.py
+#   Optional: GEMINI_CONCURRENCY=N caps the API calls in flight (default 8)
 #
 # WHAT THIS COVERS:
 #   - Building a multi-step LLM pipeline where output flows from step to step
@@ -14,6 +15,8 @@
 #   - Gates: programmatic checks between steps (no LLM needed)
 #   - Passing multiple earlier outputs to a later step
 #   - Error handling: fail fast when a step breaks
+#   - Running independent steps in parallel (client.aio + asyncio.gather)
+#   - Caching responses on disk so re-runs don't repeat identical calls
 #
 # KEY INSIGHT:
 #   A prompt chain is a FIXED sequence of LLM calls stitched together by YOUR
@@ -29,13 +32,38 @@
 #
 # =============================================================================
 
-import os
-from google import genai
+import asyncio
+import atexit
+import functools
+import hashlib
+import inspect
+import io
+import itertools
+import pathlib
+import re
+import sqlite3
+import sys
+
+import numpy as np
+import orjson
+import pydantic
+import tiktoken
+from google.genai import types
+
+from _gemini import client, limiter, run
 
 # --- Setup -------------------------------------------------------------------
 
-client = genai.Client(api_key=os.environ.get("GEMINI_API_KEY"))
+# client: the shared, pooled Gemini client (see _gemini.py). Every step of
+#     every chain reuses its open connections — only the first call pays a
+#     TLS handshake. With h2 installed, a gather's parallel calls even share
+#     ONE connection (HTTP/2).
+# run(coro): asyncio.run on ONE event loop for the whole script — this script
+#     runs async steps twice (Examples 3 and 4), and a second asyncio.run
+#     would find the client's async connections tied to a closed loop.
+# limiter: the shared cap on API calls in flight (see acall_gemini).
 MODEL = "gemini-2.0-flash"
+_BANNER = "=" * 70   # section divider, built once
 
 
 # =============================================================================
@@ -49,16 +77,239 @@ MODEL = "gemini-2.0-flash"
 # The chain is NOT in the model — it's in the Python code that calls this
 # function repeatedly and passes outputs forward.
 
-def call_gemini(system_prompt, user_message):
+
+# --- Response cache ------------------------------------------------------------
+# Every run of this script sends the SAME prompts for the SAME hardcoded
+# topics. Re-running while you experiment would pay for every call again
+# and wait seconds each time. So identical requests are answered from a small
+# SQLite file instead: the first run pays, every re-run is a ~1ms disk read.
+#
+# KEY: a hash of everything that decides the answer — model, system prompt,
+#      user message. Change any of them (e.g. edit a system prompt) and the
+#      key changes, so you never get a stale answer for a new prompt.
+# ONLY temperature 0: with sampling on, two identical calls SHOULD differ —
+#      caching one answer would quietly turn that randomness off. At
+#      temperature 0 the model is (near-)deterministic, so a stored answer is
+#      what a fresh call would have said anyway.
+#      The helpers keep the SDK's default temperature; a step opts in to
+#      caching by passing temperature=0.0 (Examples 3-4 do, 1-2 don't).
+# Delete ~/.gemini_responses.sqlite to start fresh.
+RESPONSE_DB = pathlib.Path("~/.gemini_responses.sqlite").expanduser()
+_db = sqlite3.connect(RESPONSE_DB)
+_db.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT)")
+
+
+@functools.cache
+def _prompt_hasher(system_prompt, schema=None):
+    """A blake2b hash that has already read the model, system prompt and schema."""
+    # The system prompts are constants, so encode and hash each one ONCE.
+    # cache_key copies this half-finished hash and feeds in only the user
+    # message — the part that actually changes from call to call.
+    # A response schema changes the answer too (JSON vs prose), so it's in.
+    hasher = hashlib.blake2b(f"{MODEL}\0{system_prompt}\0".encode(), digest_size=16)
+    if schema is not None:
+        hasher.update(orjson.dumps(schema.model_json_schema(), option=orjson.OPT_SORT_KEYS))
+    return hasher
+
+
+def cache_key(system_prompt, user_message, schema=None):
+    """Identify a request by everything that decides its answer."""
+    # blake2b (as in Topics 16 and 17): a secure hash like sha256, but faster
+    # on 64-bit CPUs — and the user message is a whole draft on later steps.
+    # 16 bytes is plenty to keep distinct prompts from colliding.
+    hasher = _prompt_hasher(system_prompt, schema).copy()
+    hasher.update(user_message.encode())
+    return hasher.hexdigest()
+
+
+def _cached_response(key):
+    row = _db.execute("SELECT value FROM cache WHERE key=?", (key,)).fetchone()
+    return row[0] if row else None
+
+
+def _store_response(key, text):
+    with _db:   # commits, so a crash later in the chain keeps what's done
+        _db.execute("INSERT OR REPLACE INTO cache (key, value) VALUES (?, ?)", (key, text))
+
+
+def cached_call(fn):
+    """Serve repeat temperature-0 calls from RESPONSE_DB (sync or async fn)."""
+    # Same lookup either way — only whether the API call is awaited differs.
+    if inspect.iscoroutinefunction(fn):
+        @functools.wraps(fn)
+        async def wrapper(system_prompt, user_message, temperature=None, schema=None):
+            if temperature != 0:
+                return await fn(system_prompt, user_message, temperature, schema)
+            key = cache_key(system_prompt, user_message, schema)
+            text = _cached_response(key)
+            if text is None:
+                text = await fn(system_prompt, user_message, temperature, schema)
+                _store_response(key, text)
+            return text
+    else:
+        @functools.wraps(fn)
+        def wrapper(system_prompt, user_message, temperature=None, schema=None):
+            if temperature != 0:
+                return fn(system_prompt, user_message, temperature, schema)
+            key = cache_key(system_prompt, user_message, schema)
+            text = _cached_response(key)
+            if text is None:
+                text = fn(system_prompt, user_message, temperature, schema)
+                _store_response(key, text)
+            return text
+    return wrapper
+
+
+# --- Explicit caching for big system prompts -----------------------------------
+# Every step re-sends its system prompt. A cached prompt (Topic 16) is
+# stored by Gemini once and billed at the cheap cached rate after that —
+# but only prompts of at least 4096 tokens can be cached. The prompts in
+# this file are ~60 tokens each, so they're sent inline, as before. Grow one
+# (a style guide, a page of examples) past the minimum and it gets cached
+# with no other change: step_config picks the cache up automatically.
+# Keep cached prompts byte-stable — no timestamps or per-run text — or
+# every run creates a new cache instead of reusing the prefix.
+MIN_CACHE_TOKENS = 4096      # explicit-cache minimum for gemini-2.0-flash
+_prompt_caches = {}          # system prompt → cache name, for this run
+
+
+def cache_system_prompts(*prompts):
+    """Create an explicit cache (1h TTL) for each prompt big enough to cache."""
+    for prompt in prompts:
+        # A token is almost never shorter than one character, so a prompt
+        # under the minimum in CHARACTERS is under it in tokens — skip it
+        # without a count_tokens call.
+        if prompt in _prompt_caches or len(prompt) < MIN_CACHE_TOKENS:
+            continue
+        if client.models.count_tokens(model=MODEL, contents=prompt).total_tokens < MIN_CACHE_TOKENS:
+            continue
+        cache = client.caches.create(
+            model=MODEL,
+            config=types.CreateCachedContentConfig(system_instruction=prompt, ttl="3600s"),
+        )
+        _prompt_caches[prompt] = cache.name
+        step_config.cache_clear()   # configs built before this are now stale
+    return len(_prompt_caches)
+
+
+@atexit.register
+def _delete_prompt_caches():
+    # Caches bill for storage while they live — don't leave them behind
+    for name in _prompt_caches.values():
+        client.caches.delete(name=name)
+
+
+# Built once per (prompt, temperature), then reused by every call.
+# WHY: A config passed as a dict is converted and validated into a
+#      GenerateContentConfig on EVERY call — same input, same result. Each
+#      step always sends the same one, so build it once (as Topic 17 does).
+@functools.cache
+def step_config(system_prompt, temperature, schema=None):
+    """
+    Config for one step: its cached prompt if there is one, else inline.
+
+    schema: a pydantic model — the answer is then JSON of exactly that shape
+    (structured output, see Example 4 and Topic 15).
+    """
+    structured = {}
+    if schema is not None:
+        structured = {"response_mime_type": "application/json", "response_schema": schema}
+    name = _prompt_caches.get(system_prompt)
+    if name:
+        # The system instruction lives IN the cache — the API rejects a
+        # call that passes both (see Topic 16)
+        return types.GenerateContentConfig(cached_content=name, temperature=temperature, **structured)
+    return types.GenerateContentConfig(
+        system_instruction=system_prompt, temperature=temperature, **structured,
+    )
+
+
+@cached_call
+def call_gemini(system_prompt, user_message, temperature=None, schema=None):
     """Make a single Gemini API call with a system prompt and user message."""
     response = client.models.generate_content(
         model=MODEL,
-        config={"system_instruction": system_prompt},
+        config=step_config(system_prompt, temperature, schema),
         contents=user_message,
     )
     return response.text
 
 
+# The same call, async. client.aio is the async twin of client.models.
+# WHY: A chain step spends ~all its time waiting on the network. When two
+#      steps DON'T depend on each other, awaiting both with asyncio.gather
+#      sends them together — the wait is the slowest call, not the sum.
+#      Steps that DO depend on each other still have to run in order.
+#
+# ...but not ALL at once. Gather the drafts of 3 pipelines, or a batch of 300
+# topics, and nothing stops the script firing every call in the same second
+# — straight into the per-minute quota. So every async call here waits for
+# a slot on the shared limiter (see _gemini.py): at most GEMINI_CONCURRENCY
+# calls in flight. Cache hits never take a slot — cached_call answers first.
+
+
+@cached_call
+async def acall_gemini(system_prompt, user_message, temperature=None, schema=None):
+    """Async call_gemini — await several at once with asyncio.gather."""
+    async with limiter:
+        response = await client.aio.models.generate_content(
+            model=MODEL,
+            config=step_config(system_prompt, temperature, schema),
+            contents=user_message,
+        )
+    return response.text
+
+
+# The same call, streamed: text is yielded chunk by chunk as it's generated.
+# WHY: A blog post takes seconds to generate. Buffered, the screen shows
+#      nothing until the LAST token arrives; streamed, the first words show
+#      up after a fraction of a second. Same total time — far less waiting.
+# Uses the same response cache: a hit is yielded as one chunk, and a fresh
+# answer is stored only once it has streamed all the way to the end.
+async def astream_gemini(system_prompt, user_message, temperature=None):
+    """Async generator: yield the answer's text chunks as they arrive."""
+    key = cache_key(system_prompt, user_message) if temperature == 0 else None
+    if key is not None and (text := _cached_response(key)) is not None:
+        yield text
+        return
+    chunks = []
+    async with limiter:     # a stream is a call in flight until its last chunk
+        stream = await client.aio.models.generate_content_stream(
+            model=MODEL,
+            config=step_config(system_prompt, temperature),
+            contents=user_message,
+        )
+        async for chunk in stream:
+            if chunk.text:      # the last chunk can carry only metadata
+                chunks.append(chunk.text)
+                yield chunk.text
+    if key is not None:
+        _store_response(key, "".join(chunks))
+
+
+async def stream_step(system_prompt, user_message, out=None, on_lines=None, temperature=None):
+    """
+    Print a step's answer live as it streams; return the full text (stripped).
+
+    on_lines(complete_lines, done), if given, is called whenever a chunk
+    completes a line, with all the complete lines so far — so the caller can
+    act on them before the answer is done — and once more at the end with
+    the whole answer and done=True (the last line may have no newline).
+    """
+    chunks = []
+    async for text in astream_gemini(system_prompt, user_message, temperature):
+        print(text, end="", flush=True, file=out)
+        chunks.append(text)
+        if on_lines is not None and "\n" in text:
+            so_far = "".join(chunks)
+            on_lines(so_far[:so_far.rindex("\n")].strip(), False)
+    print(file=out)
+    answer = "".join(chunks).strip()
+    if on_lines is not None:
+        on_lines(answer, True)
+    return answer
+
+
 # =============================================================================
 # EXAMPLE 1: Simple 2-Step Chain (No Gate)
 # =============================================================================
@@ -72,9 +323,9 @@ def call_gemini(system_prompt, user_message):
 # wrong, you know the problem is in step 1, not step 2. With one big prompt,
 # you'd have no idea where things went wrong.
 
-print("=" * 70)
+print(_BANNER)
 print("EXAMPLE 1: Simple 2-Step Chain")
-print("=" * 70)
+print(_BANNER)
 
 # Each step has its own system prompt — its own "job description"
 EXTRACT_SYSTEM = (
@@ -123,17 +374,60 @@ print(summary)
 # can verify with code: count items, check format, validate length, parse JSON.
 # If you need an LLM to judge quality, that's an eval (Topic 26), not a gate.
 
-print("\n" + "=" * 70)
+print("\n" + _BANNER)
 print("EXAMPLE 2: Chain with a Gate")
-print("=" * 70)
+print(_BANNER)
+
+
+# A numbered item: a line starting with "1. ", "2) ", "  3. " ...
+# Compiled once here; (?m) makes ^ match at the start of EVERY line, so one
+# regex pass over the whole text replaces splitting, stripping and filtering.
+_NUMBERED = re.compile(r"(?m)^\s*\d+[.)]\s")
 
 
 def count_points(text):
     """Gate function: count numbered items in the extracted key points."""
-    # Look for lines starting with a number (1. xxx, 2. xxx, etc.)
-    lines = [line.strip() for line in text.strip().split("\n") if line.strip()]
-    numbered = [line for line in lines if line and line[0].isdigit()]
-    return len(numbered)
+    # findall collects every match in C; len() counts them. No Python-level
+    # loop over match objects, as a generator over finditer would need.
+    return len(_NUMBERED.findall(text))
+
+
+def points_of(text):
+    """The numbered items in text, as a tuple of stripped lines."""
+    # For COMPARING two extractions: same points → same tuple, whatever
+    # blank lines or trailing remarks surround them.
+    return tuple(line.strip() for line in text.splitlines() if _NUMBERED.match(line))
+
+
+def has_enough_points(text, k=2):
+    """Gate function: are there at least k numbered items? Stops at the k-th."""
+    # A gate only needs a yes/no. islice stops the scan as soon as k items
+    # are found instead of counting every item in a long output.
+    return sum(1 for _ in itertools.islice(_NUMBERED.finditer(text), k)) >= k
+
+
+# A second, cheaper gate: is the output a sane SIZE? Every later step pays
+# for these tokens again (the draft prompt carries the key points), so a
+# runaway extraction should be trimmed BEFORE it's passed on.
+# tiktoken counts locally in microseconds — no API call. It's OpenAI's
+# tokenizer, so counts are approximate for Gemini; fine for a size limit.
+# (The BPE file downloads once on first use — see Topic 17, Part 1.)
+_ENCODING = tiktoken.get_encoding("cl100k_base")
+MAX_KEY_POINTS_TOKENS = 400     # generous for 3-4 specific points
+MAX_KEY_POINTS = 4              # what the extract prompts ask for
+SPECULATE_AT = 3                # complete points before step 2 starts early
+
+
+def count_tokens(text):
+    """Gate function: approximate token count, computed locally."""
+    return len(_ENCODING.encode(text, disallowed_special=()))
+
+
+def first_points(text, k):
+    """Keep the text up to (not including) the (k+1)-th numbered item."""
+    # islice stops the regex scan at item k+1 — nothing after it is read
+    starts = [m.start() for m in itertools.islice(_NUMBERED.finditer(text), k + 1)]
+    return text[:starts[k]].rstrip() if len(starts) > k else text
 
 
 DRAFT_SYSTEM = (
@@ -177,19 +471,23 @@ else:
 # The complete chain from the teaching: Extract → Gate → Draft → Critique → Polish
 #
 # This shows:
-#   - 4 LLM calls, each with a different system prompt (persona)
-#   - 1 gate between steps 1 and 2
-#   - Step 4 receiving output from BOTH step 2 and step 3 (not just previous step)
+#   - 4 steps, each with a different system prompt (persona)
+#   - Gates between steps 1 and 2, and after step 2 (a draft that already
+#     meets the brief skips steps 3+4)
+#   - Steps 2 and 3+4 run TWICE in parallel — two drafts, two critiques — and
+#     a Python check picks the better result
+#   - Steps 3 and 4 FUSED into one call: critique, then rewrite against it
 #   - Full logging so you can inspect every intermediate result
 #
 # This is the pattern real production pipelines use. Content generation,
 # code review bots, data processing — all follow this structure.
 
-print("\n" + "=" * 70)
+print("\n" + _BANNER)
 print("EXAMPLE 3: Full 4-Step Blog Post Pipeline")
-print("=" * 70)
+print(_BANNER)
 
 # --- System prompts: one per step, one persona per step ---
+# (Module constants — the same bytes on every call, so they're safe to cache.)
 
 EXTRACT_SYSTEM_V2 = (
     "You are a content strategist. Given a topic, identify 3-4 key points "
@@ -205,77 +503,357 @@ DRAFT_SYSTEM_V2 = (
     "LLMs but haven't built pipelines."
 )
 
-CRITIQUE_SYSTEM = (
-    "You are a senior technical editor. Review the given blog post draft and "
-    "list 3-5 SPECIFIC improvements. Focus on: clarity, missing nuance, "
-    "weak examples, and flow. Do NOT rewrite — just list what to fix. "
-    "Format: numbered list of actionable critiques."
+# A second draft persona — same job, different angle. Two drafts give the
+# pipeline a choice; running them in parallel means the choice costs no time.
+DRAFT_SYSTEM_V2_ALT = (
+    "You are a technical blog writer. Write a short blog post (4-5 paragraphs) "
+    "covering the given key points. Open with a short story of a pipeline "
+    "going wrong, then show how each key point fixes it. Target audience: "
+    "developers who've used LLMs but haven't built pipelines."
 )
 
-POLISH_SYSTEM = (
-    "You are a senior technical writer. Rewrite the draft incorporating ALL "
-    "the editor's feedback. Keep the same structure and length but improve "
-    "based on every critique. Output ONLY the final polished blog post."
+# Steps 3 (Critique) and 4 (Polish) in ONE call.
+# WHY: Polish only ever needs the draft plus its critique — and the critic
+#      just saw the draft. As two calls, the draft is sent twice and the
+#      pipeline waits on two network round-trips. As one, the model writes
+#      the critique and then rewrites against it in the same answer.
+# The sentinels let Python split the answer back into the two results, so
+# the critique stays inspectable — that's what a separate step was for.
+CRITIQUE_MARK, FINAL_MARK = "###CRITIQUE", "###FINAL"
+
+CRITIQUE_POLISH_SYSTEM = (
+    "You are a senior technical editor and writer. First review the given "
+    "blog post draft: on a line that says ###CRITIQUE, list 3-5 SPECIFIC "
+    "improvements as a numbered list. Focus on: clarity, missing nuance, "
+    "weak examples, and flow. Then, on a line that says ###FINAL, rewrite "
+    "the draft incorporating ALL of those improvements. Keep the same "
+    "structure and length. Output nothing after the final post."
 )
 
 
-def run_blog_pipeline(topic):
+# --- User-message templates: the other half of each step's prompt ---
+# Module constants next to the system prompts, filled with str.format.
+# WHY: They decide the answer just as much as the system prompts do — so
+#      they go into PIPELINE_VERSION below, and editing one invalidates the
+#      cached posts. An f-string buried in the pipeline body can't be hashed.
+# (Speed isn't the reason: adjacent f-string pieces already compile into a
+#  single string build, with no intermediate strings.)
+EXTRACT_INPUT = "Topic: {topic}"
+DRAFT_INPUT = "Topic: {topic}\n\nKey points to cover:\n{key_points}"
+CRITIQUE_INPUT = "Blog post draft:\n\n{draft}"
+
+
+# --- Gate: is a draft already good enough? ---
+# Critique + polish cost a round-trip and a full rewrite. When a draft
+# already meets what DRAFT_SYSTEM_V2 asked for — 4-5 paragraphs, a concrete
+# example, a short-post length — that spend buys little, so skip it.
+# POLICY (tune these): the checks are structural, not a quality judgement.
+# Tighten them if too many bland drafts ship unpolished; loosen them if
+# critique keeps running on drafts that come back barely changed.
+DRAFT_PARAGRAPHS = range(4, 7)        # 4-6 paragraphs (allows a short outro)
+DRAFT_WORDS = range(301, 700)         # 300 < words < 700
+EXAMPLE_MARKERS = ("for example", "for instance", "e.g.", "imagine", "consider")
+
+
+def draft_ok(draft):
+    """Gate function: does the draft meet the structural brief as-is?"""
+    paragraphs = sum(1 for p in draft.split("\n\n") if p.strip())
+    lowered = draft.lower()
+    return (
+        paragraphs in DRAFT_PARAGRAPHS
+        and len(draft.split()) in DRAFT_WORDS
+        and any(marker in lowered for marker in EXAMPLE_MARKERS)
+    )
+
+
+def split_critique_polish(text):
+    """Gate function: split a fused answer into (critique, final), or None."""
+    critique, found, final = text.partition(FINAL_MARK)
+    if not found or not final.strip():
+        return None     # the model didn't follow the format
+    return critique.replace(CRITIQUE_MARK, "", 1).strip(), final.strip()
+
+
+async def run_blog_pipeline(topic, out=None):
     """
-    Run the full 4-step blog post pipeline.
+    Run the full 4-step blog post pipeline (steps 3+4 fused; 2 and 3+4 two-wide).
 
-    Returns the final polished post, or an error string if a gate fails.
-    Every intermediate result is printed so you can inspect the chain.
+    Returns the final polished post (or a draft that already met the brief),
+    or an error string if a gate fails.
+    Every intermediate result is printed so you can inspect the chain —
+    to `out` if given (e.g. an io.StringIO), else to the screen.
     """
-    print(f"\nInput topic: {topic}\n")
+    print(f"\nInput topic: {topic}\n", file=out)
 
-    # --- Step 1: Extract key points ---
-    print("--- Step 1: Extract Key Points ---")
-    key_points = call_gemini(EXTRACT_SYSTEM_V2, f"Topic: {topic}")
-    print(key_points)
+    # --- Step 1: Extract key points (and speculatively start step 2) ---
+    print("--- Step 1: Extract Key Points ---", file=out)
+    # Streamed: the points appear as they're written. Later steps run two
+    # calls at once, so they're printed whole — two live streams would be
+    # shuffled together on screen.
+    #
+    # SPECULATION: Step 2 can't start until step 1 is done — or can it?
+    # Once SPECULATE_AT complete points have streamed in, the answer is
+    # PROBABLY done, so the two drafts are started right then, on the
+    # points so far. Each new complete point cancels them and starts again.
+    # When step 1 ends, the drafts are kept only if they were started on
+    # EXACTLY the final points; otherwise they're cancelled and redone.
+    # Win: step 2 overlaps step 1's tail. Cost: a stale guess is thrown
+    # away (its tokens may still be billed).
+    speculation = None      # (key points it was started on, drafts future)
 
-    # --- Gate: Did we get enough points? ---
-    point_count = count_points(key_points)
-    print(f"--- Gate: Found {point_count} key points ---")
-    if point_count < 2:
-        return f"CHAIN STOPPED at gate: only {point_count} key points extracted."
-    print("Gate passed.\n")
+    def speculate(points_so_far, done):
+        nonlocal speculation
+        points = points_of(points_so_far)
+        if speculation is not None:
+            if points_of(speculation[0]) == points:
+                return      # no new point — keep the drafts running
+            cancel_drafts(speculation[1])   # a new point: the guess is stale
+            speculation = None
+        # At the end there's no tail left to overlap — _after_extract starts
+        # the drafts itself, AFTER the gates have had their say.
+        if not done and len(points) >= SPECULATE_AT:
+            speculation = (points_so_far, start_drafts(topic, points_so_far))
 
-    # --- Step 2: Draft blog post ---
-    print("--- Step 2: Draft Blog Post ---")
-    draft = call_gemini(
-        DRAFT_SYSTEM_V2,
-        f"Topic: {topic}\n\nKey points to cover:\n{key_points}",
+    # A cached extraction arrives as ONE chunk, instantly — there's no
+    # stream to overlap, so don't guess at all.
+    extract_input = EXTRACT_INPUT.format(topic=topic)
+    extract_cached = _cached_response(cache_key(EXTRACT_SYSTEM_V2, extract_input)) is not None
+    key_points = await stream_step(
+        EXTRACT_SYSTEM_V2, extract_input, out,
+        on_lines=None if extract_cached else speculate,
+        temperature=0.0,    # every step of this pipeline is deterministic → cacheable
     )
-    print(draft)
+    try:
+        return await _after_extract(topic, key_points, speculation, out)
+    finally:
+        # A gate stopped the chain (or it failed) — stop any drafts in flight
+        if speculation is not None:
+            cancel_drafts(speculation[1])
+
+
+def start_drafts(topic, key_points):
+    """Start step 2 — both drafts at once — and return its future."""
+    # Both drafts need only the key points, not each other → gather.
+    # Two calls, one call's worth of waiting.
+    draft_input = DRAFT_INPUT.format(topic=topic, key_points=key_points)
+    return asyncio.gather(
+        acall_gemini(DRAFT_SYSTEM_V2, draft_input, temperature=0.0),
+        acall_gemini(DRAFT_SYSTEM_V2_ALT, draft_input, temperature=0.0),
+    )
+
 
-    # --- Step 3: Critique the draft ---
+def cancel_drafts(drafts):
+    """Cancel a speculative start_drafts future that's no longer wanted."""
+    if drafts.done():
+        return
+    drafts.cancel()
+    # A cancelled gather can end holding a CancelledError as its result.
+    # Nobody awaits a discarded guess, so read it here — otherwise asyncio
+    # logs "exception was never retrieved" for every wrong guess.
+    drafts.add_done_callback(lambda f: f.cancelled() or f.exception())
+
+
+async def _after_extract(topic, key_points, speculation, out):
+    """Steps after extraction: gates, drafts, critique + polish."""
+    # --- Gate: Did we get enough points? ---
+    # Only yes/no matters here, so use the early-exit check, not the count.
+    print("--- Gate: At least 2 key points? ---", file=out)
+    if not has_enough_points(key_points, 2):
+        return "CHAIN STOPPED at gate: fewer than 2 key points extracted."
+    print("Gate passed.", file=out)
+
+    # --- Gate: Are the key points a sane size? ---
+    # Too long → keep the first MAX_KEY_POINTS points; still too long (the
+    # points themselves ramble) → stop before paying for 4 more calls.
+    n_tokens = count_tokens(key_points)
+    print(f"--- Gate: Key points under {MAX_KEY_POINTS_TOKENS} tokens? ({n_tokens}) ---", file=out)
+    if n_tokens > MAX_KEY_POINTS_TOKENS:
+        key_points = first_points(key_points, MAX_KEY_POINTS)
+        n_tokens = count_tokens(key_points)
+        print(f"Trimmed to the first {MAX_KEY_POINTS} points: {n_tokens} tokens.", file=out)
+        if n_tokens > MAX_KEY_POINTS_TOKENS:
+            return f"CHAIN STOPPED at gate: key points are {n_tokens} tokens even after trimming."
+    print("Gate passed.\n", file=out)
+
+    # --- Step 2: Draft two versions in parallel ---
+    print("--- Step 2: Draft Blog Post (two versions, in parallel) ---", file=out)
+    # Compare the POINTS, not the raw text: a trailing remark after the
+    # last point doesn't change what the drafts were written from.
+    if speculation is not None and points_of(speculation[0]) == points_of(key_points):
+        print("(Speculation hit: these drafts started while step 1 was streaming.)", file=out)
+        drafts = await speculation[1]
+    else:
+        # A wrong guess: stop it BEFORE starting the real drafts, so it
+        # doesn't hold concurrency slots (or run up tokens) ahead of them
+        if speculation is not None:
+            cancel_drafts(speculation[1])
+        drafts = await start_drafts(topic, key_points)
+    for label, draft in zip("AB", drafts):
+        print(f"[Draft {label}]\n{draft}", file=out)
+
+    # --- Gate: Ship a draft that already meets the brief? ---
+    # Pure Python, microseconds — and a pass saves two calls.
+    for label, draft in zip("AB", drafts):
+        if draft_ok(draft):
+            print(f"--- Gate: Draft {label} meets the brief — critique + polish skipped ---", file=out)
+            return draft
+    print("--- Gate: No draft meets the brief yet — on to critique ---", file=out)
+
+    # --- Steps 3+4: Critique and polish each draft, in parallel ---
     # The critic ONLY sees the draft — not the original topic or key points.
     # This is intentional: the draft should stand on its own. If the critic
     # needs to know the topic to understand the draft, the draft is unclear.
-    print("--- Step 3: Critique the Draft ---")
-    critique = call_gemini(CRITIQUE_SYSTEM, f"Blog post draft:\n\n{draft}")
-    print(critique)
-
-    # --- Step 4: Polish incorporating feedback ---
-    # This step receives output from BOTH step 2 (draft) AND step 3 (critique).
-    # Not just the previous step — we pass forward whatever the step needs.
-    # All intermediate results are in Python variables, available anytime.
-    print("--- Step 4: Polish Final Version ---")
-    final = call_gemini(
-        POLISH_SYSTEM,
-        f"Original draft:\n\n{draft}\n\n"
-        f"Editor feedback:\n\n{critique}\n\n"
-        f"Rewrite the draft incorporating all feedback above.",
+    # Both drafts are polished, so the pick below costs no extra round-trip
+    # (the price: the losing rewrite's output tokens).
+    print("--- Steps 3+4: Critique and Polish (one call per draft, in parallel) ---", file=out)
+    answers = await asyncio.gather(
+        *(acall_gemini(CRITIQUE_POLISH_SYSTEM, CRITIQUE_INPUT.format(draft=d), temperature=0.0)
+          for d in drafts)
     )
-    print(final)
+    results = {}
+    for label, answer in zip("AB", answers):
+        split = split_critique_polish(answer)
+        if split is None:
+            # Gate: no ###FINAL section — drop this draft, keep the other
+            print(f"[{label}] GATE FAILED: no {FINAL_MARK} section in the answer.", file=out)
+            continue
+        results[label] = split
+        print(f"[Critique {label}]\n{split[0]}", file=out)
+    if not results:
+        return "CHAIN STOPPED at gate: no critique+polish answer had a final post."
+
+    # --- Pick: the draft that needed fewer fixes ---
+    # Pure Python, like a gate — count the critic's numbered items.
+    best = min(results, key=lambda label: count_points(results[label][0]))
+    critique, final = results[best]
+    print(f"--- Pick: Draft {best} ({count_points(critique)} fixes made) ---", file=out)
+    print(final, file=out)
 
     return final
 
 
-# Run the full pipeline
-final_post = run_blog_pipeline(
-    "Why breaking LLM tasks into chains of smaller prompts beats one giant prompt"
+# --- Whole-pipeline cache ------------------------------------------------------
+# The response cache above already skips every API call on a re-run — but
+# it still walks every step: 5 hashes, 5 lookups, every intermediate
+# printed again. The pipeline is a pure function of its topic and its
+# prompts, so its FINAL post can be cached too: one lookup, done.
+#
+# PIPELINE_VERSION is part of the key so an edit invalidates old results.
+# The prompts (system prompts AND input templates) are hashed rather than
+# versioned by hand — nobody remembers to bump a constant after tweaking a
+# sentence. The "6" prefix covers the Python side (gate, pick logic): bump
+# THAT when you change the code.
+PIPELINE_VERSION = "6:" + hashlib.blake2b("\0".join((
+    EXTRACT_SYSTEM_V2, DRAFT_SYSTEM_V2, DRAFT_SYSTEM_V2_ALT, CRITIQUE_POLISH_SYSTEM,
+    EXTRACT_INPUT, DRAFT_INPUT, CRITIQUE_INPUT,
+)).encode(), digest_size=8).hexdigest()
+_db.execute("CREATE TABLE IF NOT EXISTS pipelines (key TEXT PRIMARY KEY, value TEXT)")
+
+# SEMANTIC cache: an exact key misses the moment the wording changes —
+# "Why chains of small prompts beat one big prompt" is the same request as
+# the topic below, in different words. So each finished topic is also stored
+# with its embedding; a new topic whose embedding is close enough reuses
+# that post. One embedding call (~100ms, a tiny fraction of a generation)
+# replaces 5 generations.
+# The threshold is strict on purpose: a false hit returns a post about a
+# DIFFERENT topic. Lower it and watch what starts matching.
+EMBED_MODEL = "text-embedding-004"
+SEMANTIC_THRESHOLD = 0.95   # cosine similarity
+_db.execute(
+    "CREATE TABLE IF NOT EXISTS topic_vectors "
+    "(version TEXT, topic TEXT, vector BLOB, post TEXT, PRIMARY KEY (version, topic))"
+)
+
+
+async def embed_topic(topic):
+    """Unit-length embedding of a topic — dot product = cosine similarity."""
+    async with limiter:     # an API call like any other — it takes a slot
+        result = await client.aio.models.embed_content(model=EMBED_MODEL, contents=topic)
+    vec = np.asarray(result.embeddings[0].values, dtype=np.float32)
+    return vec / np.linalg.norm(vec)
+
+
+async def cached_blog_pipeline(topic, out=None):
+    """run_blog_pipeline, but a topic that's been through it (or one worded
+    nearly the same) returns instantly."""
+    version = f"{MODEL}\0{PIPELINE_VERSION}"
+    key = hashlib.blake2b(f"{version}\0{topic}".encode(), digest_size=16).hexdigest()
+    row = _db.execute("SELECT value FROM pipelines WHERE key=?", (key,)).fetchone()
+    if row:
+        print(f"\nInput topic: {topic}\n", file=out)
+        print("--- Pipeline cache hit: all 4 steps skipped ---", file=out)
+        print(row[0], file=out)
+        return row[0]
+
+    # Exact miss — is there a cached topic that MEANS the same thing?
+    vec = await embed_topic(topic)
+    rows = _db.execute(
+        "SELECT topic, vector, post FROM topic_vectors WHERE version=?", (version,)
+    ).fetchall()
+    if rows:
+        # Every stored vector in one matrix → every similarity in one multiply
+        sims = np.stack([np.frombuffer(v, dtype=np.float32) for _, v, _ in rows]) @ vec
+        best = int(sims.argmax())
+        closest, _, post = rows[best]
+        if sims[best] >= SEMANTIC_THRESHOLD:
+            print(f"\nInput topic: {topic}\n", file=out)
+            print(f"--- Semantic cache hit ({sims[best]:.3f} similar to: {closest}) ---", file=out)
+            print(post, file=out)
+            return post
+        print(f"\n(Closest cached topic is {sims[best]:.3f} similar — below "
+              f"{SEMANTIC_THRESHOLD}, so the pipeline runs.)", file=out)
+
+    final = await run_blog_pipeline(topic, out)
+    if final.startswith("CHAIN STOPPED"):
+        print(final, file=out)
+    else:   # only pin a run that finished — a failed one should retry next time
+        with _db:
+            _db.execute("INSERT OR REPLACE INTO pipelines (key, value) VALUES (?, ?)", (key, final))
+            _db.execute("INSERT OR REPLACE INTO topic_vectors VALUES (?, ?, ?, ?)",
+                        (version, topic, vec.tobytes(), final))
+    return final
+
+
+# Cache any system prompt big enough to qualify (none of these are — see
+# "Explicit caching" at the top — so this makes no API calls)
+n_cached = cache_system_prompts(
+    EXTRACT_SYSTEM_V2, DRAFT_SYSTEM_V2, DRAFT_SYSTEM_V2_ALT, CRITIQUE_POLISH_SYSTEM,
 )
+print(f"\nSystem prompts cached: {n_cached} (the rest are under {MIN_CACHE_TOKENS} tokens — sent inline)")
+
+# Run the full pipeline — 5 calls, but only 3 rounds of waiting
+# (and none at all once this topic is cached)
+final_post = run(cached_blog_pipeline(
+    "Why breaking LLM tasks into chains of smaller prompts beats one giant prompt"
+))
+
+# Same request, different words: no exact match, but maybe a semantic one
+final_post2 = run(cached_blog_pipeline(
+    "Why chains of small prompts beat one big prompt"
+))
+
+
+# Several pipelines at once. Each one's calls overlap with the others', so
+# printing straight to the screen would interleave their traces line by
+# line. So each pipeline writes into its OWN buffer, and the finished trace
+# goes out in ONE sys.stdout.write — whole, in whatever order they finish.
+# (One write also means one trip through stdout's lock instead of ~20.)
+async def run_pipelines(topics):
+    """Run cached_blog_pipeline for every topic concurrently; return the posts."""
+    async def traced(topic):
+        out = io.StringIO()
+        post = await cached_blog_pipeline(topic, out)
+        sys.stdout.write(out.getvalue())     # the whole trace, in one piece
+        return post
+
+    return await asyncio.gather(*(traced(topic) for topic in topics))
+
+
+print("\n--- Two more topics, run concurrently (each trace printed whole) ---")
+more_posts = run(run_pipelines([
+    "How gates keep LLM pipelines from wasting tokens",
+    "When a single prompt is better than a chain",
+]))
 
 
 # =============================================================================
@@ -285,18 +863,29 @@ final_post = run_blog_pipeline(
 # validates that it's actually parseable JSON. This pattern is extremely
 # common in production — you need structured output to pass to downstream
 # code, and the gate ensures the LLM actually followed the format.
+#
+# STRUCTURED OUTPUT: Asking for JSON in the prompt is a request the model
+# can ignore — it wraps the JSON in ```json fences, adds a sentence, drops a
+# key — and every miss is a failed gate and a wasted chain. A response
+# schema moves the format into the API: the server constrains generation
+# to valid JSON of exactly that shape. No fence stripping, no retries.
 
-import json
-
-print("\n" + "=" * 70)
+print("\n" + _BANNER)
 print("EXAMPLE 4: Chain with JSON Gate")
-print("=" * 70)
+print(_BANNER)
+
+# The shape of the answer. The prompt no longer has to spell out the JSON —
+# the schema does, and the server enforces it.
+class BlogMetadata(pydantic.BaseModel):
+    key_points: list[str]   # 3 specific points
+    audience: str
+    tone: str
+
 
 JSON_EXTRACT_SYSTEM = (
-    "You are a data extraction assistant. Given a topic, output a JSON object "
-    "with this exact structure:\n"
-    '{"key_points": ["point 1", "point 2", "point 3"], "audience": "description", "tone": "description"}\n'
-    "Output ONLY valid JSON, no markdown fencing, no explanation."
+    "You are a data extraction assistant. Given a topic, extract the 3 key "
+    "points a short blog post on it must cover, its target audience, and "
+    "the right tone."
 )
 
 TARGETED_DRAFT_SYSTEM = (
@@ -305,49 +894,98 @@ TARGETED_DRAFT_SYSTEM = (
     "(3-4 paragraphs). Follow the metadata exactly."
 )
 
-topic4 = "Context windows and why they matter for LLM applications"
-
-# Step 1: Extract as JSON
-print(f"\nInput topic: {topic4}")
-print("\n--- Step 1: Extract Structured Metadata (JSON) ---")
-raw_json = call_gemini(JSON_EXTRACT_SYSTEM, f"Topic: {topic4}")
-print(f"Raw output:\n{raw_json}")
-
-# GATE: Is it valid JSON?
-# This is the most common gate in production chains. LLMs sometimes add
-# markdown fencing (```json ... ```) or explanation text around the JSON.
-# The gate catches this so you don't get a crash in step 2.
-print("\n--- Gate: Validating JSON ---")
-try:
-    # Strip potential markdown fencing the model might add despite instructions
-    cleaned = raw_json.strip()
-    if cleaned.startswith("```"):
-        # Remove ```json and ``` fencing
-        cleaned = cleaned.split("\n", 1)[1].rsplit("```", 1)[0].strip()
-    metadata = json.loads(cleaned)
-    print(f"Valid JSON! Keys: {list(metadata.keys())}")
-    print(f"Key points: {metadata.get('key_points', 'MISSING')}")
-    print(f"Audience: {metadata.get('audience', 'MISSING')}")
-    print(f"Tone: {metadata.get('tone', 'MISSING')}")
-    gate_passed = True
-except json.JSONDecodeError as e:
-    print(f"GATE FAILED: Invalid JSON — {e}")
-    gate_passed = False
-
-if gate_passed:
-    # Step 2: Draft using the structured metadata
-    # We format the metadata nicely for the model — it doesn't need raw JSON
-    print("\n--- Step 2: Draft from Structured Metadata ---")
-    formatted_input = (
-        f"Topic: {topic4}\n"
-        f"Key points to cover: {', '.join(metadata.get('key_points', []))}\n"
-        f"Target audience: {metadata.get('audience', 'general')}\n"
-        f"Tone: {metadata.get('tone', 'neutral')}"
+# Real pipelines rarely run on ONE input — it's a batch of emails, a folder
+# of documents, a list of topics. So this example runs the chain on several.
+topics4 = [
+    "Context windows and why they matter for LLM applications",
+    "How temperature changes what an LLM writes",
+    "Why LLM output needs validating before your code uses it",
+]
+
+
+def parse_metadata(raw_json):
+    """Gate function: parse the extraction output (raises orjson.JSONDecodeError)."""
+    # With the schema there's no fencing to strip: the answer IS the JSON.
+    # orjson: a C JSON parser, several times faster than json.loads. One
+    # parse is nothing — a gate over thousands of batched extractions isn't.
+    # orjson.loads takes the str as-is; no .encode() needed.
+    return orjson.loads(raw_json)
+
+
+METADATA_INPUT = (
+    "Topic: {topic}\n"
+    "Key points to cover: {key_points}\n"
+    "Target audience: {audience}\n"
+    "Tone: {tone}"
+)
+
+
+def format_metadata(topic, metadata):
+    """Step 2 input: the metadata laid out for the model — it doesn't need raw JSON."""
+    return METADATA_INPUT.format(
+        topic=topic,
+        key_points=", ".join(metadata.get("key_points", [])),
+        audience=metadata.get("audience", "general"),
+        tone=metadata.get("tone", "neutral"),
     )
-    draft4 = call_gemini(TARGETED_DRAFT_SYSTEM, formatted_input)
-    print(draft4)
-else:
-    print("Chain stopped due to JSON gate failure.")
+
+
+async def batch_extract_and_draft(topics):
+    """
+    Run Extract → JSON gate → Draft on every topic.
+
+    Each STEP runs for all topics at once: every extraction together, then
+    every draft together. WHY: the topics don't depend on each other, so
+    N topics take about one call's wait per step instead of N.
+    Returns {topic: draft} for the topics that passed the gate.
+    No cap needed here: acall_gemini waits on the shared limiter, which
+    caps the calls in flight however many topics the batch has.
+    """
+    # Step 1: Extract as JSON — all topics at once
+    print("\n--- Step 1: Extract Structured Metadata (JSON), all topics ---")
+    raw_jsons = await asyncio.gather(
+        *(acall_gemini(JSON_EXTRACT_SYSTEM, EXTRACT_INPUT.format(topic=topic),
+                       temperature=0.0, schema=BlogMetadata)
+          for topic in topics)
+    )
+
+    # GATE: Is it valid JSON?
+    # This is the most common gate in production chains. With a schema the
+    # server guarantees the FORMAT, so the gate no longer fires on fencing
+    # or chatter — only on real failures, like an answer cut off at the
+    # output-token limit. It still stands between step 1 and a crash in step 2.
+    # Gates are plain Python, so they run one topic at a time — in microseconds.
+    passed = {}
+    for topic, raw_json in zip(topics, raw_jsons):
+        print(f"\nInput topic: {topic}")
+        print(f"Raw output:\n{raw_json}")
+        print("--- Gate: Validating JSON ---")
+        try:
+            metadata = parse_metadata(raw_json)
+        except orjson.JSONDecodeError as e:   # a subclass of json.JSONDecodeError
+            # Only THIS topic stops — the rest of the batch carries on
+            print(f"GATE FAILED: Invalid JSON — {e}")
+            continue
+        print(f"Valid JSON! Keys: {list(metadata.keys())}")
+        print(f"Key points: {metadata.get('key_points', 'MISSING')}")
+        print(f"Audience: {metadata.get('audience', 'MISSING')}")
+        print(f"Tone: {metadata.get('tone', 'MISSING')}")
+        passed[topic] = metadata
+
+    # Step 2: Draft using the structured metadata — every topic that passed
+    drafts = await asyncio.gather(
+        *(acall_gemini(TARGETED_DRAFT_SYSTEM, format_metadata(t, m), temperature=0.0)
+          for t, m in passed.items())
+    )
+    for topic, draft in zip(passed, drafts):
+        print(f"\n--- Step 2: Draft from Structured Metadata: {topic} ---")
+        print(draft)
+    return dict(zip(passed, drafts))
+
+
+drafts4 = run(batch_extract_and_draft(topics4))
+if not drafts4:
+    print("Chain stopped: every topic failed the JSON gate.")
 
 
 # =============================================================================
@@ -368,8 +1006,27 @@ else:
 #   step3_out = call(step1_out + step2_out)   ← uses outputs from BOTH earlier steps
 #
 # Pattern 4 — JSON GATE:
-#   call(output JSON) → json.loads() validation → call(use parsed data)
-#   Forces structured output; gate ensures it's parseable before continuing.
+#   call(output JSON) → orjson.loads() validation → call(use parsed data)
+#   A response schema makes the API enforce the JSON shape; the gate then
+#   only catches real failures (e.g. a truncated answer).
+#   On a batch: run each step for ALL inputs at once; a failed gate drops
+#   only its own input.
+#
+# Pattern 5 — PARALLEL STEP:
+#   a, b = await asyncio.gather(acall(x), acall(y))   ← independent calls
+#   Two calls for the wait of one. Only for steps that don't need each other.
+#   Whole pipelines can run side by side the same way — buffer each one's
+#   output so their traces don't interleave.
+#
+# Pattern 6 — CACHED CALL:
+#   hash(model, system, user) → stored answer?  yes: return it  no: call + store
+#   Identical temperature-0 requests are paid for once, not on every run.
+#   Cache a whole chain the same way: key = hash(input, prompts, code version).
+#
+# Pattern 7 — BOUNDED CONCURRENCY:
+#   async with Semaphore(N): call()  — around EVERY async call, not per batch
+#   Gather as much as you like; at most N calls are in flight, so a big
+#   batch rides just under the rate limit instead of into 429 backoff.
 #
 # WHAT'S NEXT:
 #   Topic 19 (Routing) adds CONDITIONAL paths — instead of a fixed A→B→C,
@@ -0,0 +1,101 @@
+# =============================================================================
+# SHARED: One Gemini client for every topic script
+# =============================================================================
+#
+# HOW TO USE:
+#   from _gemini import client, limiter, run
+#
+#   Python puts the running script's folder on sys.path, so any script in
+#   code/ can import this file — no install step needed.
+#
+# WHY A SHARED MODULE:
+#   Every genai.Client owns its own HTTP connection pool. Build a client per
+#   script (or worse, per call) and each one pays its own TCP + TLS handshake
+#   (~40-80ms) before the first request. One module-level client means one
+#   pool: connections opened by the first call are kept alive and reused by
+#   every call after it, from any script that imports this module.
+#   Python runs a module's top-level code only on the FIRST import — after
+#   that, `import _gemini` hands back the same module, so the same client.
+#
+# The pooling setup itself is explained step by step in Topic 15, Section 1.
+# =============================================================================
+
+import asyncio
+import importlib.util
+import os
+
+# Check the key FIRST — before importing the SDK or building anything.
+# WHY: A missing key used to fall back to the literal "YOUR_API_KEY": the
+#      client would build fine, and the failure only showed up on the first
+#      real call — after the SDK import, the TLS handshake and whatever setup
+#      the script did first. Failing here costs nothing and says what's wrong.
+API_KEY = os.environ.get("GEMINI_API_KEY")
+if not API_KEY or API_KEY == "YOUR_API_KEY":
+    raise RuntimeError("Set the GEMINI_API_KEY environment variable (see HOW TO RUN).")
+
+import httpx
+from google import genai
+from google.genai import types
+
+POOL_LIMITS = httpx.Limits(
+    max_connections=100,            # upper bound on open sockets
+    max_keepalive_connections=50,   # idle sockets kept warm for reuse
+    keepalive_expiry=30,            # seconds an idle socket stays open
+)
+
+# HTTP/2, if the optional h2 package is installed: pip install "httpx[http2]"
+# WHY: Over HTTP/1.1 a connection carries one request at a time, so an
+#      asyncio.gather of 4 calls opens 4 sockets — 4 handshakes on a cold
+#      pool. HTTP/2 multiplexes all 4 over ONE connection. Without h2, httpx
+#      can't speak HTTP/2, so fall back to pooled HTTP/1.1 instead of failing.
+HTTP2 = importlib.util.find_spec("h2") is not None
+
+# Retry rate limits (429) and overload (503) with exponential backoff + jitter.
+# WHY: Without retry_options the SDK makes ONE attempt — a single 429 in a
+#      batch of drafts kills the whole asyncio.gather. The SDK's own retry
+#      (tenacity under the hood) waits ~1s, 2s, 4s... capped at max_delay.
+#      Async calls also go through `limiter` below, which caps how many are
+#      in flight, so these retries stay the rare exception, not the steady state.
+RETRY = types.HttpRetryOptions(attempts=5, max_delay=20, http_status_codes=[429, 503])
+
+client = genai.Client(
+    api_key=API_KEY,
+    http_options=types.HttpOptions(
+        timeout=60_000,   # milliseconds — fail a stuck call instead of hanging
+        retry_options=RETRY,
+        client_args={"transport": httpx.HTTPTransport(limits=POOL_LIMITS, http2=HTTP2)},             # client.models
+        async_client_args={"transport": httpx.AsyncHTTPTransport(limits=POOL_LIMITS, http2=HTTP2)},  # client.aio
+    ),
+)
+# NOTE: api_version is left at the SDK default (v1beta) on purpose — it has
+#       every feature these topics use, explicit caching included.
+
+
+# One event loop for the whole script — use run(coro) instead of asyncio.run.
+# WHY: asyncio.run creates a NEW event loop and closes it when done. The
+#      async connection pool above keeps its open connections tied to the
+#      loop that opened them, so the SECOND asyncio.run in a script tries to
+#      reuse connections from a closed loop → "RuntimeError: Event loop is
+#      closed". Running every async step on the same loop keeps the pool
+#      (and its warm connections) valid for the life of the script.
+_loop = asyncio.new_event_loop()
+
+
+def run(coro):
+    """Run a coroutine to completion on the shared event loop."""
+    return _loop.run_until_complete(coro)
+
+
+# One cap on API calls in flight, shared by every async call site:
+#   async with limiter:
+#       response = await client.aio.models.generate_content(...)
+# WHY: asyncio.gather makes it easy to fire 300 calls in the same second.
+#      Past the per-minute quota the API answers 429, the retries above
+#      back off exponentially, and throughput falls off a cliff. A Semaphore
+#      turns that cliff into a flat ceiling: at most GEMINI_CONCURRENCY
+#      calls in flight, the rest queue in order. Tune it to your quota:
+#      roughly RPM / 60 × seconds per call.
+# WHY here, not per script or per batch: a limit per gather only caps that
+#      one gather — two batches at once would each get the full quota.
+#      Every caller shares this one, on the one loop run() uses.
+limiter = asyncio.Semaphore(int(os.environ.get("GEMINI_CONCURRENCY", "8")))